@@ -0,0 +1,145 @@
+import abc
+import asyncio
+import logging
+from typing import Awaitable, Callable
+
+from redis import asyncio as aioredis
+
+# handler(room, message) - called for every message published to a subscribed room
+Handler = Callable[[str, str], Awaitable[None]]
+
+
+class Backplane(abc.ABC):
+    """
+    Pub/sub channel between workers for the web socket chat.
+    ConnectionManager publishes room messages here and delivers whatever comes back
+    to its local sockets, so every worker sees messages sent in any other worker.
+    """
+
+    @abc.abstractmethod
+    async def subscribe(self, room: str, handler: Handler):
+        ...
+
+    @abc.abstractmethod
+    async def unsubscribe(self, room: str, handler: Handler):
+        ...
+
+    @abc.abstractmethod
+    async def publish(self, room: str, message: str):
+        ...
+
+    async def close(self):
+        pass
+
+
+class InMemoryBackplane(Backplane):
+    """
+    Process local backplane - single worker deployments and tests.
+    Several managers sharing one instance behave like several workers.
+    """
+
+    def __init__(self):
+        self.rooms: dict[str, set[Handler]] = {}
+
+    async def subscribe(self, room: str, handler: Handler):
+        self.rooms.setdefault(room, set()).add(handler)
+
+    async def unsubscribe(self, room: str, handler: Handler):
+        handlers = self.rooms.get(room)
+        if handlers is None:
+            return
+        handlers.discard(handler)
+        if not handlers:
+            del self.rooms[room]
+
+    async def publish(self, room: str, message: str):
+        for handler in list(self.rooms.get(room, ())):
+            await handler(room, message)
+
+
+class RedisBackplane(Backplane):
+    """
+    Redis pub/sub backplane - one channel per room on a single pubsub connection.
+    The channel is subscribed when the first local socket joins the room and
+    unsubscribed when the last one leaves.
+    """
+
+    def __init__(self, redis: aioredis.Redis, prefix: str = "chat", max_backoff: float = 30.0):
+        self.redis = redis
+        self.prefix = prefix
+        self.max_backoff = max_backoff
+        self.pubsub = redis.pubsub(ignore_subscribe_messages=True)
+        self.rooms: dict[str, set[Handler]] = {}
+        self.reader: asyncio.Task | None = None
+
+    def _channel(self, room: str) -> str:
+        return f"{self.prefix}:{room}"
+
+    async def subscribe(self, room: str, handler: Handler):
+        handlers = self.rooms.setdefault(room, set())
+        handlers.add(handler)
+        if len(handlers) == 1:
+            await self.pubsub.subscribe(self._channel(room))
+        if self.reader is None or self.reader.done():
+            self.reader = asyncio.create_task(self._read())
+
+    async def unsubscribe(self, room: str, handler: Handler):
+        handlers = self.rooms.get(room)
+        if handlers is None:
+            return
+        handlers.discard(handler)
+        if not handlers:
+            del self.rooms[room]
+            await self.pubsub.unsubscribe(self._channel(room))
+
+    async def publish(self, room: str, message: str):
+        await self.redis.publish(self._channel(room), message)
+
+    async def _read(self):
+        """ Deliver room messages - a lost Redis connection is logged and the rooms are subscribed again"""
+        backoff = 0.5
+        while self.rooms:
+            try:
+                message = await self.pubsub.get_message(timeout=1.0)
+            except Exception as e:
+                logging.error(f"Backplane read failed, retry in {backoff}s: >> {e!r}")
+                await asyncio.sleep(backoff)
+                backoff = min(backoff * 2, self.max_backoff)
+                await self._resubscribe()
+                continue
+            backoff = 0.5
+            if message is None or message["type"] != "message":
+                continue
+            channel = message["channel"]
+            data = message["data"]
+            if isinstance(channel, bytes):
+                channel = channel.decode()
+            if isinstance(data, bytes):
+                data = data.decode()
+            room = channel[len(self.prefix) + 1:]
+            for handler in list(self.rooms.get(room, ())):
+                try:
+                    await handler(room, data)
+                except Exception as e:
+                    logging.error(f"Backplane handler failed: >> {e!r} \n room={room}")
+
+    async def _resubscribe(self):
+        """ Fresh pubsub connection with the channels of every local room"""
+        try:
+            await self.pubsub.close()
+        except Exception:
+            pass
+        self.pubsub = self.redis.pubsub(ignore_subscribe_messages=True)
+        if not self.rooms:
+            return
+        try:
+            await self.pubsub.subscribe(*(self._channel(room) for room in self.rooms))
+        except Exception as e:
+            # get_message fails again and the next round retries
+            logging.error(f"Backplane resubscribe failed: >> {e!r}")
+
+    async def close(self):
+        if self.reader is not None:
+            self.reader.cancel()
+        self.rooms.clear()
+        await self.pubsub.close()
@@ -0,0 +1,99 @@
+import json
+import logging
+from typing import AsyncIterator, Awaitable, Callable, Type
+
+from pydantic import BaseModel, ValidationError
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.ext.asyncio import AsyncSession
+from starlette.requests import Request
+
+from app.db import async_session_maker
+from settings import IMPORT_CHUNK_SIZE
+
+# (line number, validated row) pairs of one chunk
+Rows = list[tuple[int, BaseModel]]
+# Writes the rows in the chunk transaction -> inserted, skipped duplicates, row errors
+ChunkWriter = Callable[[AsyncSession, Rows], Awaitable[tuple[int, int, list[dict]]]]
+
+
+def validation_message(error: ValidationError) -> str:
+    return "; ".join(f"{'.'.join(map(str, item['loc']))}: {item['msg']}" for item in error.errors())
+
+
+async def ndjson_lines(request: Request) -> AsyncIterator[tuple[int, bytes]]:
+    """ Numbered non-empty lines of the request body, read as it arrives"""
+    number = 0
+    tail = b""
+    async for data in request.stream():
+        lines = (tail + data).split(b"\n")
+        tail = lines.pop()
+        for line in lines:
+            number += 1
+            if line.strip():
+                yield number, line
+    if tail.strip():
+        yield number + 1, tail
+
+
+async def ndjson_chunks(request: Request, chunk_size: int) -> AsyncIterator[list[tuple[int, bytes]]]:
+    chunk = []
+    async for item in ndjson_lines(request):
+        chunk.append(item)
+        if len(chunk) >= chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+async def import_chunk(lines: list[tuple[int, bytes]], schema: Type[BaseModel], write: ChunkWriter) -> dict:
+    """
+    Validate one chunk and write its valid rows in one transaction.
+    :return: chunk report - ok, partial (some rows rejected) or failed (transaction rolled back)
+    """
+    rows: Rows = []
+    errors = []
+    for number, line in lines:
+        try:
+            rows.append((number, schema.parse_obj(json.loads(line))))
+        except ValueError as e:
+            message = validation_message(e) if isinstance(e, ValidationError) else f"Invalid JSON: {e}"
+            errors.append({"line": number, "error": message})
+    report = {"lines": [lines[0][0], lines[-1][0]], "inserted": 0, "duplicates": 0}
+    if rows:
+        try:
+            async with async_session_maker() as session:
+                report["inserted"], report["duplicates"], row_errors = await write(session, rows)
+                await session.commit()
+            errors.extend(row_errors)
+        except SQLAlchemyError as e:
+            logging.error(f"SQLAlchemyError: >> {e} \n {import_chunk.__name__}")
+            report.update(status="failed", error=str(e.orig if getattr(e, "orig", None) else e), errors=errors)
+            return report
+        except Exception as e:
+            # Any other writer error fails this chunk only, the import goes on
+            logging.exception(f"Exception: >> {e} \n {import_chunk.__name__}")
+            report.update(status="failed", error=str(e), errors=errors)
+            return report
+    report.update(status="partial" if errors else "ok", errors=sorted(errors, key=lambda item: item["line"]))
+    return report
+
+
+async def import_ndjson(request: Request, schema: Type[BaseModel], write: ChunkWriter,
+                        chunk_size: int = IMPORT_CHUNK_SIZE) -> dict:
+    """
+    Bulk import of an NDJSON body - one row per line, chunk_size rows per validation pass and transaction.
+    A failed chunk is rolled back alone, the chunks before and after it are kept.
+    :param request:
+    :param schema: row schema
+    :param write: chunk writer
+    :param chunk_size:
+    :return: totals and a report per chunk
+    """
+    chunks = []
+    async for lines in ndjson_chunks(request, chunk_size):
+        chunks.append(dict(chunk=len(chunks), **await import_chunk(lines, schema, write)))
+    return {"inserted": sum(chunk["inserted"] for chunk in chunks),
+            "duplicates": sum(chunk["duplicates"] for chunk in chunks),
+            "failed_chunks": sum(chunk["status"] == "failed" for chunk in chunks),
+            "chunks": chunks}
@@ -0,0 +1,70 @@
+import hashlib
+import logging
+from typing import Callable
+
+from fastapi_cache import FastAPICache
+
+MESSAGES_NAMESPACE = "messages_cache_hour"
+REACTIONS_NAMESPACE = "reactions_cache_minute"
+
+# Endpoint arguments which never take part in a cache key
+IGNORED_KWARGS = ("user", "session", "request", "response")
+
+
+def chat_tag(chat_id: int) -> str:
+    return f"chat:{chat_id}"
+
+
+def author_tag(author_id: int) -> str:
+    return f"author:{author_id}"
+
+
+def message_tag(message_id: int) -> str:
+    return f"message:{message_id}"
+
+
+def tag_prefix(namespace: str, tag: str) -> str:
+    return f"{FastAPICache.get_prefix()}:{namespace}:{tag}"
+
+
+def tagged_key_builder(tag: Callable[[dict], str]):
+    """
+    Key builder for @cache which puts every key under a tag - fastapi-cache:{namespace}:{tag}:{digest}.
+    All keys of one tag are dropped together by invalidate() - TwoTierBackend keeps a key set per tag.
+    :param tag: builds the tag out of endpoint kwargs
+    :return: key builder
+    """
+
+    def key_builder(func, namespace: str = "", request=None, response=None, args=(), kwargs=None):
+        kwargs = kwargs or {}
+        params = sorted((name, str(value)) for name, value in kwargs.items() if name not in IGNORED_KWARGS)
+        digest = hashlib.md5(f"{func.__module__}:{func.__name__}:{params}".encode()).hexdigest()
+        return f"{tag_prefix(namespace, tag(kwargs))}:{digest}"
+
+    return key_builder
+
+
+async def invalidate(namespace: str, *tags: str):
+    """ Drop every cached response stored under the tags"""
+    try:
+        backend = FastAPICache.get_backend()
+    except AssertionError:
+        # Cache is not initialised - nothing to drop
+        return
+    for tag in tags:
+        try:
+            await backend.clear(namespace=tag_prefix(namespace, tag))
+        except Exception as e:
+            logging.error(f"Cache invalidation failed: >> {e} \n {namespace}:{tag}")
+
+
+async def invalidate_namespace(namespace: str):
+    """ Drop every cached response of the namespace - after bulk writes touching too many tags"""
+    try:
+        backend = FastAPICache.get_backend()
+    except AssertionError:
+        return
+    try:
+        await backend.clear(namespace=f"{FastAPICache.get_prefix()}:{namespace}")
+    except Exception as e:
+        logging.error(f"Cache invalidation failed: >> {e} \n {namespace}")
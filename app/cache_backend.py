@@ -0,0 +1,254 @@
+import asyncio
+import logging
+import time
+from collections import Counter, OrderedDict, defaultdict
+from typing import Callable, Optional, Tuple
+
+from fastapi_cache.backends import Backend
+from fastapi_cache.backends.redis import RedisBackend
+from redis import asyncio as aioredis
+
+from settings import CACHE_LOCAL_MAX_ENTRIES, CACHE_LOCAL_TTL, CACHE_STALE_TTL, CACHE_LOCK_TIMEOUT
+
+INVALIDATION_CHANNEL = "fastapi-cache:invalidate"
+UNLINK_BATCH = 500
+
+
+def key_namespace(key: str) -> str:
+    """ fastapi-cache:{namespace}:... -> namespace"""
+    parts = key.split(":", 2)
+    return parts[1] if len(parts) > 1 else ""
+
+
+def key_groups(key: str) -> set[str]:
+    """ Prefixes clear() can drop the key by - its namespace and everything before the last part (the tag)"""
+    return {":".join(key.split(":", 2)[:2]), key.rsplit(":", 1)[0]}
+
+
+def group_index(group: str) -> str:
+    """ Redis set of the keys stored under a prefix"""
+    return f"{group}:~keys"
+
+
+class TwoTierBackend(Backend):
+    """
+    fastapi-cache backend - bounded in-process TTL/LRU layer in front of Redis.
+    A miss is computed by one caller per worker, concurrent callers of the same key wait for its result.
+    With stale_ttl > 0 an expired value is still served for stale_ttl seconds while one caller refreshes it.
+    clear() is broadcast over Redis pub/sub, so every worker drops its local copies.
+    Every stored key is added to a Redis set per prefix (namespace, tag) - clear() drops the members
+    of one set instead of scanning the keyspace.
+    """
+
+    def __init__(self, redis: aioredis.Redis, max_entries: int = CACHE_LOCAL_MAX_ENTRIES,
+                 local_ttl: float = CACHE_LOCAL_TTL, stale_ttl: int = CACHE_STALE_TTL,
+                 lock_timeout: float = CACHE_LOCK_TIMEOUT, max_backoff: float = 30.0):
+        self.redis = redis
+        self.remote = RedisBackend(redis)
+        self.max_entries = max_entries
+        self.local_ttl = local_ttl
+        self.stale_ttl = stale_ttl
+        self.lock_timeout = lock_timeout
+        self.max_backoff = max_backoff
+        # key -> (fresh until, value), least recently used first
+        self.local: OrderedDict[str, tuple[float, str]] = OrderedDict()
+        # key -> (future resolved by set() or the end of the computing task, started at)
+        self.in_flight: dict[str, tuple[asyncio.Future, float]] = {}
+        # namespace -> local_hits, remote_hits, stale_hits, misses, coalesced
+        self.counters: dict[str, Counter] = defaultdict(Counter)
+        self.pubsub = None
+        self.listener: asyncio.Task | None = None
+        # Other caches of the worker dropping their entries on the same invalidation messages
+        self.listeners: list[Callable[[str], None]] = []
+
+    async def start(self):
+        self.pubsub = self.redis.pubsub(ignore_subscribe_messages=True)
+        await self.pubsub.subscribe(INVALIDATION_CHANNEL)
+        self.listener = asyncio.create_task(self._listen())
+
+    async def close(self):
+        if self.listener is not None:
+            self.listener.cancel()
+            self.listener = None
+        if self.pubsub is not None:
+            await self.pubsub.close()
+
+    async def _listen(self):
+        """ Apply invalidation messages - a lost Redis connection is logged and the channel is subscribed again"""
+        backoff = 0.5
+        while True:
+            try:
+                message = await self.pubsub.get_message(timeout=1.0)
+            except Exception as e:
+                logging.error(f"Cache invalidation read failed, retry in {backoff}s: >> {e!r}")
+                await asyncio.sleep(backoff)
+                backoff = min(backoff * 2, self.max_backoff)
+                await self._resubscribe()
+                continue
+            backoff = 0.5
+            if message is None or message["type"] != "message":
+                continue
+            data = message["data"]
+            target = data.decode() if isinstance(data, bytes) else data
+            self._drop_local(target)
+            for listener in self.listeners:
+                try:
+                    listener(target)
+                except Exception as e:
+                    logging.error(f"Cache invalidation listener failed: >> {e!r} \n target={target}")
+
+    async def _resubscribe(self):
+        """ Fresh pubsub connection - messages sent while it was down are lost, so the local layer is dropped"""
+        try:
+            await self.pubsub.close()
+        except Exception:
+            pass
+        self.local.clear()
+        self.pubsub = self.redis.pubsub(ignore_subscribe_messages=True)
+        try:
+            await self.pubsub.subscribe(INVALIDATION_CHANNEL)
+        except Exception as e:
+            # get_message fails again and the next round retries
+            logging.error(f"Cache invalidation resubscribe failed: >> {e!r}")
+
+    def _drop_local(self, target: str):
+        """ target is a key or a namespace prefix, as in clear()"""
+        self.local.pop(target, None)
+        prefix = f"{target}:"
+        for key in [key for key in self.local if key.startswith(prefix)]:
+            del self.local[key]
+
+    def _store_local(self, key: str, value: str, fresh: float):
+        """ Local copy lives at most local_ttl - bounds staleness if an invalidation message is lost"""
+        self.local[key] = (time.monotonic() + min(fresh, self.local_ttl), value)
+        self.local.move_to_end(key)
+        while len(self.local) > self.max_entries:
+            self.local.popitem(last=False)
+
+    def _begin(self, key: str):
+        """
+        The caller computes the key - its lease ends with set() or with the caller task,
+        so a failed computation lets the waiters take over right away instead of after lock_timeout.
+        """
+        flight = (asyncio.get_running_loop().create_future(), time.monotonic())
+        self.in_flight[key] = flight
+        task = asyncio.current_task()
+        if task is not None:
+            task.add_done_callback(lambda _: self._release(key, flight))
+
+    def _release(self, key: str, flight: tuple[asyncio.Future, float]):
+        """ Wake the waiters without a value - one of them computes the key"""
+        if self.in_flight.get(key) is flight:
+            del self.in_flight[key]
+        if not flight[0].done():
+            flight[0].set_result(None)
+
+    def _stale(self, key: str, value: str) -> Tuple[int, Optional[str]]:
+        """ Serve stale value unless nobody refreshes the key yet - then this caller does"""
+        namespace = key_namespace(key)
+        if key in self.in_flight:
+            self.counters[namespace]["stale_hits"] += 1
+            return 0, value
+        self._begin(key)
+        self.counters[namespace]["misses"] += 1
+        return 0, None
+
+    async def get_with_ttl(self, key: str) -> Tuple[int, Optional[str]]:
+        namespace = key_namespace(key)
+        now = time.monotonic()
+        entry = self.local.get(key)
+        if entry is not None:
+            fresh_until, value = entry
+            if now < fresh_until:
+                self.local.move_to_end(key)
+                self.counters[namespace]["local_hits"] += 1
+                return int(fresh_until - now), value
+            del self.local[key]
+
+        ttl, value = await self.remote.get_with_ttl(key)
+        if value is not None:
+            # Redis keeps the value stale_ttl longer than its fresh lifetime, ttl < 0 - no expiry
+            fresh = ttl - self.stale_ttl if ttl >= 0 else int(self.local_ttl)
+            if fresh > 0:
+                self._store_local(key, value, fresh)
+                self.counters[namespace]["remote_hits"] += 1
+                return fresh, value
+            if self.stale_ttl and ttl > 0:
+                return self._stale(key, value)
+
+        return await self._miss(key)
+
+    async def _miss(self, key: str) -> Tuple[int, Optional[str]]:
+        namespace = key_namespace(key)
+        waited = False
+        while (flight := self.in_flight.get(key)) is not None:
+            future, started = flight
+            remaining = self.lock_timeout - (time.monotonic() - started)
+            value = None
+            if remaining > 0:
+                if not waited:
+                    self.counters[namespace]["coalesced"] += 1
+                    waited = True
+                try:
+                    value = await asyncio.wait_for(asyncio.shield(future), timeout=remaining)
+                except asyncio.TimeoutError:
+                    # The computing caller hangs - take over
+                    self._release(key, flight)
+                    break
+            else:
+                self._release(key, flight)
+                break
+            if value is not None:
+                return int(self.local_ttl), value
+            # The computing caller failed - the first waiter to wake up computes, the rest wait for it
+        self._begin(key)
+        self.counters[namespace]["misses"] += 1
+        return 0, None
+
+    async def get(self, key: str) -> Optional[str]:
+        return (await self.get_with_ttl(key))[1]
+
+    async def set(self, key: str, value: str, expire: int = None):
+        expire = int(expire) if expire else 0
+        remote_expire = expire + self.stale_ttl if expire else None
+        async with self.redis.pipeline(transaction=False) as pipe:
+            pipe.set(key, value, ex=remote_expire)
+            for group in key_groups(key):
+                pipe.sadd(group_index(group), key)
+                # The index lives as long as its newest key
+                if remote_expire:
+                    pipe.expire(group_index(group), remote_expire)
+            await pipe.execute()
+        self._store_local(key, value, expire or self.local_ttl)
+        flight = self.in_flight.pop(key, None)
+        if flight is not None and not flight[0].done():
+            flight[0].set_result(value)
+
+    async def clear(self, namespace: str = None, key: str = None) -> int:
+        if namespace:
+            removed = await self._unlink_group(namespace)
+        elif key:
+            removed = await self.redis.unlink(key)
+        else:
+            removed = 0
+        target = namespace or key
+        if target:
+            self._drop_local(target)
+            try:
+                await self.redis.publish(INVALIDATION_CHANNEL, target)
+            except Exception as e:
+                logging.error(f"Cache invalidation publish failed: >> {e} \n {target}")
+        return removed
+
+    async def _unlink_group(self, group: str) -> int:
+        """ Unlink the keys indexed under the prefix and the index itself - no KEYS/SCAN over the keyspace"""
+        index = group_index(group)
+        keys = list(await self.redis.smembers(index))
+        removed = 0
+        for start in range(0, len(keys), UNLINK_BATCH):
+            removed += await self.redis.unlink(*keys[start:start + UNLINK_BATCH])
+        await self.redis.unlink(index)
+        return removed
+
+    def stats(self) -> dict[str, dict[str, int]]:
+        return {namespace: dict(counter) for namespace, counter in self.counters.items()}
@@ -0,0 +1,132 @@
+"""
+Chat list state - ChatSummary (last message, message count) and ChatMember (read position, read count)
+moved by every message insert. Rebuild from message_table:  python -m app.chat_summary rebuild
+"""
+import asyncio
+import sys
+
+from sqlalchemy import select, update, delete, func, case, and_
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.db import async_session_maker
+from app.models import ChatSummary, ChatMember, Message
+
+# Columns to return from a message insert for record_messages()
+INSERTED_COLUMNS = (Message.id, Message.chat_id, Message.author_id, Message.body, Message.created_at)
+
+
+def unread_count(member: ChatMember, summary: ChatSummary) -> int:
+    return max(summary.message_count - member.read_count, 0)
+
+
+async def record_messages(session: AsyncSession, messages):
+    """
+    Move chat state by freshly inserted messages, in the caller transaction.
+    One summary upsert for all chats, one upsert of the authors - an author has read the chat
+    up to their own last message. Other members are not touched, their unread grows with message_count.
+    Chats are locked in chat_id order, concurrent writers of the same chats can not deadlock.
+    :param messages: rows with id, chat_id, author_id, body, created_at
+    """
+    chats: dict[int, list] = {}
+    for message in messages:
+        chats.setdefault(message.chat_id, []).append(message)
+    if not chats:
+        return
+    rows = []
+    for chat_id in sorted(chats):
+        chat_messages = chats[chat_id]
+        chat_messages.sort(key=lambda message: message.id)
+        last = chat_messages[-1]
+        rows.append({"chat_id": chat_id, "message_count": len(chat_messages), "last_message_id": last.id,
+                     "last_author_id": last.author_id, "last_body": last.body,
+                     "last_created_at": last.created_at})
+    statement = insert(ChatSummary).values(rows)
+    newer = statement.excluded.last_message_id > ChatSummary.last_message_id
+    statement = statement.on_conflict_do_update(
+        index_elements=[ChatSummary.chat_id],
+        set_={"message_count": ChatSummary.message_count + statement.excluded.message_count,
+              **{column: case((newer, statement.excluded[column]), else_=getattr(ChatSummary, column))
+                 for column in ("last_message_id", "last_author_id", "last_body", "last_created_at")}})
+    counts = dict((await session.execute(
+        statement.returning(ChatSummary.chat_id, ChatSummary.message_count))).all())
+
+    members = []
+    for chat_id in sorted(chats):
+        chat_messages = chats[chat_id]
+        authors: dict[int, int] = {}
+        for position, message in enumerate(chat_messages):
+            if message.author_id is not None:
+                authors[message.author_id] = position
+        # Messages after the author's own last one stay unread for them
+        members.extend({"chat_id": chat_id, "user_id": author_id, "last_read_id": chat_messages[position].id,
+                        "read_count": counts[chat_id] - (len(chat_messages) - position - 1)}
+                       for author_id, position in sorted(authors.items()))
+    if not members:
+        return
+    statement = insert(ChatMember).values(members)
+    statement = statement.on_conflict_do_update(
+        index_elements=[ChatMember.chat_id, ChatMember.user_id],
+        set_={"last_read_id": func.greatest(ChatMember.last_read_id, statement.excluded.last_read_id),
+              "read_count": func.greatest(ChatMember.read_count, statement.excluded.read_count)})
+    await session.execute(statement)
+
+
+async def mark_read(session: AsyncSession, chat_id: int, user_id: int, up_to: int) -> ChatMember | None:
+    """
+    Move the user's read position to up_to (never back), joining the chat on the first call.
+    Reading up to the last message takes the chat message_count as the read count,
+    otherwise the unread tail is counted (chat_id, id index) and taken off message_count.
+    :return: member, None when the chat has no messages
+    """
+    summary = await session.get(ChatSummary, chat_id)
+    if summary is None:
+        return None
+    member = await session.get(ChatMember, (chat_id, user_id), with_for_update=True)
+    if member is None:
+        member = ChatMember(chat_id=chat_id, user_id=user_id, last_read_id=0, read_count=0)
+        session.add(member)
+    member.last_read_id = max(member.last_read_id, min(up_to, summary.last_message_id))
+    if member.last_read_id >= summary.last_message_id:
+        member.read_count = max(member.read_count, summary.message_count)
+    else:
+        unread = await session.scalar(
+            select(func.count()).select_from(Message)
+            .where(Message.chat_id == chat_id).where(Message.id > member.last_read_id))
+        member.read_count = max(summary.message_count - unread, 0)
+    return member
+
+
+async def rebuild():
+    """
+    Recompute summaries from message_table and read counts from the members' read positions.
+    Archived partitions are not counted - after a rebuild message_count covers the messages still
+    in message_table, read counts are recomputed on the same basis, so unread stays right.
+    """
+    async with async_session_maker() as session:
+        await session.execute(delete(ChatSummary))
+        last = select(Message.chat_id, func.max(Message.id).label("last_id"), func.count().label("count")) \
+            .group_by(Message.chat_id).subquery()
+        await session.execute(insert(ChatSummary).from_select(
+            ["chat_id", "message_count", "last_message_id", "last_author_id", "last_body", "last_created_at"],
+            select(last.c.chat_id, last.c.count, last.c.last_id, Message.author_id, Message.body, Message.created_at)
+            .join(Message, and_(Message.chat_id == last.c.chat_id, Message.id == last.c.last_id))))
+        # Authors are members read up to their last message
+        authored = select(Message.chat_id, Message.author_id, func.max(Message.id)) \
+            .where(Message.author_id.is_not(None)).group_by(Message.chat_id, Message.author_id)
+        statement = insert(ChatMember).from_select(["chat_id", "user_id", "last_read_id"], authored)
+        await session.execute(statement.on_conflict_do_update(
+            index_elements=[ChatMember.chat_id, ChatMember.user_id],
+            set_={"last_read_id": func.greatest(ChatMember.last_read_id, statement.excluded.last_read_id)}))
+        read_count = select(func.count()).select_from(Message) \
+            .where(Message.chat_id == ChatMember.chat_id).where(Message.id <= ChatMember.last_read_id) \
+            .scalar_subquery()
+        await session.execute(update(ChatMember).values(read_count=read_count))
+        await session.commit()
+
+
+if __name__ == "__main__":
+    if sys.argv[1:] != ["rebuild"]:
+        sys.exit("usage: python -m app.chat_summary rebuild")
+    asyncio.run(rebuild())
+    print("Chat summaries rebuilt")
@@ -1,3 +1,6 @@
+import asyncio
+import logging
+import time
 from typing import AsyncGenerator
 
 from fastapi_users_db_sqlalchemy import SQLAlchemyUserDatabase
@@ -5,18 +8,89 @@ from app.models import User
 from app.models import Base
 from fastapi import Depends
 
+from sqlalchemy import text
 from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
+from sqlalchemy.pool import AsyncAdaptedQueuePool
 
-from settings import PG_HOST, PG_PORT, PG_USER, PG_PASS, PG_DB_NAME
+from settings import PG_HOST, PG_PORT, PG_USER, PG_PASS, PG_DB_NAME, DB_POOL_SIZE, DB_MAX_OVERFLOW, \
+    DB_POOL_TIMEOUT, DB_POOL_RECYCLE, DB_POOL_PRE_PING, DB_POOL_WARMUP, DB_STATEMENT_CACHE_SIZE, \
+    DB_PREPARED_STATEMENT_CACHE_SIZE
 
-DATABASE_URL = f"postgresql+asyncpg://{PG_USER}:{PG_PASS}@{PG_HOST}:{PG_PORT}/{PG_DB_NAME}"
+DATABASE_URL = f"postgresql+asyncpg://{PG_USER}:{PG_PASS}@{PG_HOST}:{PG_PORT}/{PG_DB_NAME}" \
+               f"?prepared_statement_cache_size={DB_PREPARED_STATEMENT_CACHE_SIZE}"
 
-engine = create_async_engine(DATABASE_URL, echo=False)
+
+class MeteredPool(AsyncAdaptedQueuePool):
+    """
+    Queue pool which counts callers waiting for a connection and checkout latency.
+    """
+    waiting = 0
+    checkouts = 0
+    checkout_total = 0.0
+    checkout_max = 0.0
+
+    def _do_get(self):
+        MeteredPool.waiting += 1
+        started = time.perf_counter()
+        try:
+            return super()._do_get()
+        finally:
+            elapsed = time.perf_counter() - started
+            MeteredPool.waiting -= 1
+            MeteredPool.checkouts += 1
+            MeteredPool.checkout_total += elapsed
+            MeteredPool.checkout_max = max(MeteredPool.checkout_max, elapsed)
+
+
+engine = create_async_engine(DATABASE_URL, echo=False,
+                             poolclass=MeteredPool,
+                             pool_size=DB_POOL_SIZE,
+                             max_overflow=DB_MAX_OVERFLOW,
+                             pool_timeout=DB_POOL_TIMEOUT,
+                             pool_recycle=DB_POOL_RECYCLE,
+                             pool_pre_ping=DB_POOL_PRE_PING,
+                             connect_args={"statement_cache_size": DB_STATEMENT_CACHE_SIZE})
 async_session_maker = async_sessionmaker(engine, expire_on_commit=False)
 
 
+async def warm_up_pool(connections: int = DB_POOL_WARMUP):
+    """
+    Open pool connections up front, so the first requests after a deploy do not pay for connecting.
+    Best effort - a database which is not up yet is logged, the pool connects on demand later.
+    """
+    if connections <= 0:
+        return
+    results = await asyncio.gather(*(engine.connect() for _ in range(connections)), return_exceptions=True)
+    opened = [result for result in results if not isinstance(result, BaseException)]
+    failed = [result for result in results if isinstance(result, BaseException)]
+    try:
+        pinged = await asyncio.gather(*(conn.execute(text("SELECT 1")) for conn in opened), return_exceptions=True)
+        failed.extend(result for result in pinged if isinstance(result, BaseException))
+    finally:
+        await asyncio.gather(*(conn.close() for conn in opened), return_exceptions=True)
+    if failed:
+        logging.error(f"Pool warm up: {len(failed)} of {connections} connections failed >> {failed[0]!r}")
+
+def pool_metrics() -> dict:
+    """ Pool saturation - connections in use, idle, over the pool size, callers waiting and checkout latency"""
+    pool = engine.sync_engine.pool
+    return {
+        "size": pool.size(),
+        "checked_out": pool.checkedout(),
+        "checked_in": pool.checkedin(),
+        "overflow": pool.overflow(),
+        "waiting": MeteredPool.waiting,
+        "checkouts": MeteredPool.checkouts,
+        "checkout_avg_ms": round(MeteredPool.checkout_total / MeteredPool.checkouts * 1000, 3)
+        if MeteredPool.checkouts else 0.0,
+        "checkout_max_ms": round(MeteredPool.checkout_max * 1000, 3),
+    }
+
+
 async def create_db_and_tables():
     async with engine.begin() as conn:
+        # Trigram indexes of the release search
+        await conn.execute(text("CREATE EXTENSION IF NOT EXISTS pg_trgm"))
         await conn.run_sync(Base.metadata.create_all)
 
 
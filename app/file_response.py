@@ -0,0 +1,132 @@
+import hashlib
+import os
+import re
+from email.utils import formatdate, parsedate_to_datetime
+
+from starlette import status
+from starlette.concurrency import run_in_threadpool
+from starlette.requests import Request
+from starlette.responses import FileResponse, Response, StreamingResponse
+
+from settings import PICTURE_CACHE_CONTROL
+
+RANGE_CHUNK_SIZE = 64 * 1024
+RANGE_RE = re.compile(r"^bytes=(\d*)-(\d*)$")
+
+# First bytes of the file -> media type
+SIGNATURES = (
+    (b"\x89PNG\r\n\x1a\n", "image/png"),
+    (b"\xff\xd8\xff", "image/jpeg"),
+    (b"GIF87a", "image/gif"),
+    (b"GIF89a", "image/gif"),
+    (b"BM", "image/bmp"),
+)
+
+
+def sniff_media_type(head: bytes) -> str | None:
+    """ Media type by the first bytes of the file - called once on upload"""
+    if head[:4] == b"RIFF" and head[8:12] == b"WEBP":
+        return "image/webp"
+    for signature, media_type in SIGNATURES:
+        if head.startswith(signature):
+            return media_type
+    return None
+
+
+def _etag_matches(header: str, etag: str) -> bool:
+    """ Weak comparison, as If-None-Match requires"""
+    if header.strip() == "*":
+        return True
+    tags = [tag.strip() for tag in header.split(",")]
+    return etag.removeprefix("W/") in [tag.removeprefix("W/") for tag in tags]
+
+
+def _not_modified(request: Request, etag: str, mtime: float) -> bool:
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None:
+        return _etag_matches(if_none_match, etag)
+    if_modified_since = request.headers.get("if-modified-since")
+    if if_modified_since:
+        try:
+            return int(mtime) <= parsedate_to_datetime(if_modified_since).timestamp()
+        except (TypeError, ValueError):
+            return False
+    return False
+
+
+def _byte_range(header: str, size: int) -> tuple[int, int] | None:
+    """
+    Single "bytes=start-end" range.
+    :return: inclusive (start, end) or None when the range can not be satisfied
+    """
+    match = RANGE_RE.match(header.strip())
+    if not match or match.groups() == ("", ""):
+        return None
+    start, end = match.groups()
+    if start == "":
+        # Suffix range - the last N bytes
+        length = int(end)
+        if length == 0:
+            return None
+        return max(size - length, 0), size - 1
+    start = int(start)
+    end = min(int(end), size - 1) if end else size - 1
+    if start > end:
+        return None
+    return start, end
+
+
+async def _read_range(path: str, start: int, end: int):
+    buff = await run_in_threadpool(open, path, "rb")
+    try:
+        await run_in_threadpool(buff.seek, start)
+        remaining = end - start + 1
+        while remaining > 0:
+            chunk = await run_in_threadpool(buff.read, min(RANGE_CHUNK_SIZE, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            yield chunk
+    finally:
+        await run_in_threadpool(buff.close)
+
+
+async def conditional_file_response(request: Request, path: str, media_type: str,
+                                    content_hash: str | None = None) -> Response:
+    """
+    File response with validators - ETag, Last-Modified, 304 on If-None-Match / If-Modified-Since
+    and 206 for a single byte range.
+    :param request:
+    :param path:
+    :param media_type:
+    :param content_hash: content digest for a strong ETag, stat based ETag when unknown
+    :return: 200, 206, 304 or 416 response
+    """
+    stat_result = await run_in_threadpool(os.stat, path)
+    if content_hash:
+        etag = f'"{content_hash}"'
+    else:
+        etag = f'"{hashlib.md5(f"{stat_result.st_mtime}-{stat_result.st_size}".encode()).hexdigest()}"'
+    headers = {
+        "etag": etag,
+        "last-modified": formatdate(stat_result.st_mtime, usegmt=True),
+        "accept-ranges": "bytes",
+        "cache-control": PICTURE_CACHE_CONTROL,
+    }
+    if _not_modified(request, etag, stat_result.st_mtime):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+
+    range_header = request.headers.get("range")
+    if_range = request.headers.get("if-range")
+    if range_header and (if_range is None or if_range.strip() in (etag, headers["last-modified"])):
+        byte_range = _byte_range(range_header, stat_result.st_size)
+        if byte_range is None:
+            return Response(status_code=status.HTTP_416_REQUESTED_RANGE_NOT_SATISFIABLE,
+                            headers={"content-range": f"bytes */{stat_result.st_size}"})
+        start, end = byte_range
+        headers["content-range"] = f"bytes {start}-{end}/{stat_result.st_size}"
+        headers["content-length"] = str(end - start + 1)
+        return StreamingResponse(_read_range(path, start, end), status_code=status.HTTP_206_PARTIAL_CONTENT,
+                                 media_type=media_type, headers=headers)
+
+    return FileResponse(path, media_type=media_type, headers=headers, stat_result=stat_result)
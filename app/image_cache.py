@@ -0,0 +1,167 @@
+import asyncio
+import os
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+
+from PIL import Image
+
+from settings import PICTURE_CACHE_DIR, PICTURE_CACHE_MAX_BYTES, PICTURE_RESIZE_WORKERS
+
+# format name -> (file extension, media type)
+FORMATS = {
+    "png": ("png", "image/png"),
+    "jpeg": ("jpg", "image/jpeg"),
+    "webp": ("webp", "image/webp"),
+}
+
+
+_pool: ProcessPoolExecutor | None = None
+
+
+async def run_in_pool(func, *args):
+    """ Run CPU bound picture work in the shared process pool"""
+    global _pool
+    if _pool is None:
+        _pool = ProcessPoolExecutor(max_workers=PICTURE_RESIZE_WORKERS)
+    return await asyncio.get_running_loop().run_in_executor(_pool, func, *args)
+
+
+def shutdown_pool():
+    global _pool
+    if _pool is not None:
+        _pool.shutdown(wait=False, cancel_futures=True)
+        _pool = None
+
+
+def resize_image(source: str, target: str, width: int, height: int, image_format: str) -> int:
+    """
+    Resize source into target - runs in a worker process.
+    :return: size of the written file in bytes
+    """
+    with Image.open(source) as img:
+        resized = img.resize((width, height))
+        if image_format == "jpeg" and resized.mode not in ("RGB", "L"):
+            resized = resized.convert("RGB")
+        # Write aside and rename, readers never see a half written file
+        temporary = f"{target}.{os.getpid()}.tmp"
+        resized.save(temporary, format=image_format.upper())
+    os.replace(temporary, target)
+    return os.path.getsize(target)
+
+
+def make_rendition(source: str, target: str, max_side: int, image_format: str) -> tuple[int, int, int]:
+    """
+    Scale source down to fit max_side, keeping the aspect ratio - runs in a worker process.
+    JPEG is written progressive, so clients can show it before it is fully downloaded.
+    :return: width, height and size of the written file in bytes
+    """
+    with Image.open(source) as img:
+        img.thumbnail((max_side, max_side))
+        if image_format == "jpeg" and img.mode not in ("RGB", "L"):
+            img = img.convert("RGB")
+        temporary = f"{target}.{os.getpid()}.tmp"
+        if image_format == "jpeg":
+            img.save(temporary, format="JPEG", quality=85, optimize=True, progressive=True)
+        else:
+            img.save(temporary, format=image_format.upper(), quality=80)
+        width, height = img.size
+    os.replace(temporary, target)
+    return width, height, os.path.getsize(target)
+
+
+class DerivativeCache:
+    """
+    On-disk LRU of resized pictures keyed by (picture_id, width, height, format) with a byte budget.
+    Concurrent requests for the same derivative share one resize, resizing runs in a process pool.
+    """
+
+    def __init__(self, directory: str = PICTURE_CACHE_DIR, max_bytes: int = PICTURE_CACHE_MAX_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        # file name -> size, least recently used first
+        self.entries: OrderedDict[str, int] = OrderedDict()
+        self.total = 0
+        self.in_flight: dict[str, asyncio.Future] = {}
+        self._scan()
+
+    def _scan(self):
+        """ Pick up derivatives left by the previous run, oldest first"""
+        os.makedirs(self.directory, exist_ok=True)
+        files = [entry for entry in os.scandir(self.directory) if entry.is_file() and not entry.name.endswith(".tmp")]
+        for entry in sorted(files, key=lambda item: item.stat().st_mtime):
+            self.entries[entry.name] = entry.stat().st_size
+            self.total += entry.stat().st_size
+        self._evict()
+
+    @staticmethod
+    def name(picture_id: int, width: int, height: int, image_format: str) -> str:
+        return f"{picture_id}_{width}x{height}.{FORMATS[image_format][0]}"
+
+    def path(self, name: str) -> str:
+        return os.path.join(self.directory, name)
+
+    async def get(self, picture_id: int, source: str, width: int, height: int, image_format: str) -> str:
+        """
+        Path of the resized picture, resizing it on a miss.
+        :param picture_id:
+        :param source: original picture file
+        :param width:
+        :param height:
+        :param image_format: one of FORMATS
+        :return: path to the cached derivative
+        """
+        name = self.name(picture_id, width, height, image_format)
+        if name in self.entries:
+            if os.path.exists(self.path(name)):
+                self.entries.move_to_end(name)
+                return self.path(name)
+            # Removed behind our back (cleanup, another worker's eviction) - build it again
+            self.total -= self.entries.pop(name)
+        build = self.in_flight.get(name)
+        if build is None:
+            # The build is a task of its own: a cancelled first caller does not cancel the others
+            build = asyncio.create_task(self._build(name, source, width, height, image_format))
+            build.add_done_callback(self._retrieve)
+            self.in_flight[name] = build
+        return await asyncio.shield(build)
+
+    async def _build(self, name: str, source: str, width: int, height: int, image_format: str) -> str:
+        try:
+            size = await run_in_pool(resize_image, source, self.path(name), width, height, image_format)
+            self._add(name, size)
+        finally:
+            del self.in_flight[name]
+        return self.path(name)
+
+    @staticmethod
+    def _retrieve(build: asyncio.Task):
+        """ Mark the exception as retrieved when every caller went away before the build ended"""
+        if not build.cancelled():
+            build.exception()
+
+    def _add(self, name: str, size: int):
+        self.total += size - self.entries.pop(name, 0)
+        self.entries[name] = size
+        self._evict()
+
+    def _evict(self):
+        while self.total > self.max_bytes and len(self.entries) > 1:
+            name, size = self.entries.popitem(last=False)
+            self.total -= size
+            try:
+                os.remove(self.path(name))
+            except FileNotFoundError:
+                pass
+
+    def discard(self, picture_id: int):
+        """ Drop every derivative of the picture"""
+        prefix = f"{picture_id}_"
+        for name in [name for name in self.entries if name.startswith(prefix)]:
+            self.total -= self.entries.pop(name)
+            try:
+                os.remove(self.path(name))
+            except FileNotFoundError:
+                pass
+
+
+derivative_cache = DerivativeCache()
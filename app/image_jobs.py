@@ -0,0 +1,149 @@
+import asyncio
+import logging
+import os
+from datetime import datetime, timedelta
+
+from sqlalchemy import update, func
+from sqlalchemy.exc import SQLAlchemyError
+from starlette.concurrency import run_in_threadpool
+
+from app.db import async_session_maker
+from app.models import ImageJob, Picture
+from app.openai_client import openai_client, OpenAIError
+from app.picture_store import save_chunks, remove_file, PictureTooLarge
+from app.prompt_limits import prompt_limiter
+from app.renditions import build_renditions
+from settings import PICTURE_CHUNK_SIZE, OPEN_AI_IMAGE_TIMEOUT, OPEN_AI_IMAGE_DIR, OPEN_AI_IMAGE_JOB_TIMEOUT
+
+
+async def set_status(job_id: int, status: str, **values) -> bool:
+    """ :return: False when the job row is gone"""
+    async with async_session_maker() as session:
+        job = await session.get(ImageJob, job_id)
+        if job is None:
+            return False
+        job.status = status
+        for name, value in values.items():
+            setattr(job, name, value)
+        await session.commit()
+    return True
+
+
+async def fail_job(job_id: int, error: str):
+    try:
+        found = await set_status(job_id, "failed", error=error, finished_at=datetime.utcnow())
+    except SQLAlchemyError as e:
+        logging.error(f"SQLAlchemyError: >> {e} \n {fail_job.__name__}")
+        return
+    if not found:
+        logging.warning(f"Image job {job_id} is gone, not marked failed")
+
+
+async def fail_interrupted_jobs():
+    """
+    Jobs left pending or running by a stopped worker never finish - fail them at startup.
+    Only jobs older than OPEN_AI_IMAGE_JOB_TIMEOUT, younger ones may still run in another worker.
+    """
+    try:
+        async with async_session_maker() as session:
+            result = await session.execute(
+                update(ImageJob)
+                .where(ImageJob.status.in_(("pending", "running")))
+                .where(ImageJob.created_at < func.now() - timedelta(seconds=OPEN_AI_IMAGE_JOB_TIMEOUT))
+                .values(status="failed", error="Interrupted", finished_at=datetime.utcnow()))
+            await session.commit()
+    except SQLAlchemyError as e:
+        logging.error(f"SQLAlchemyError: >> {e} \n {fail_interrupted_jobs.__name__}")
+        return
+    if result.rowcount:
+        logging.warning(f"Failed {result.rowcount} interrupted image jobs")
+
+
+async def download_images(job_id: int, urls: list[str]) -> list[tuple[str, int, str, str]]:
+    """
+    Download every generated image at once.
+    :return: (filename, size, content hash, media type) of each saved image, failed ones are logged and left out
+    """
+    os.makedirs(OPEN_AI_IMAGE_DIR, exist_ok=True)
+    results = await asyncio.gather(
+        *(save_chunks(openai_client.download(url, PICTURE_CHUNK_SIZE, OPEN_AI_IMAGE_TIMEOUT),
+                      OPEN_AI_IMAGE_DIR, f"dalle_{job_id}_{index}.png")
+          for index, url in enumerate(urls)),
+        return_exceptions=True)
+    saved = []
+    unexpected = None
+    for url, result in zip(urls, results):
+        if isinstance(result, (OpenAIError, PictureTooLarge, OSError, asyncio.TimeoutError)):
+            logging.error(f"Image download failed: >> {result} \n job={job_id} {url}")
+            continue
+        if isinstance(result, BaseException):
+            unexpected = unexpected or result
+            continue
+        saved.append(result)
+    if unexpected is not None:
+        # The caller never sees these files - remove them before giving up
+        await remove_images(saved)
+        raise unexpected
+    return saved
+
+
+async def run_image_job(job_id: int):
+    """
+    Background stage of an image job - generate the images, download them concurrently,
+    store them as Picture rows and build their renditions.
+    Generation runs in one of the user's prompt slots, the whole job at most OPEN_AI_IMAGE_JOB_TIMEOUT.
+    :param job_id:
+    """
+    saved = []
+    try:
+        picture_ids = await asyncio.wait_for(store_images(job_id, saved), timeout=OPEN_AI_IMAGE_JOB_TIMEOUT)
+    except (OpenAIError, asyncio.TimeoutError) as e:
+        logging.error(f"Image job failed: >> {e} \n job={job_id}")
+        await remove_images(saved)
+        await fail_job(job_id, str(e) or "Timed out")
+        return
+    except Exception as e:
+        logging.error(f"Image job failed: >> {e} \n {run_image_job.__name__} job={job_id}")
+        await remove_images(saved)
+        await fail_job(job_id, "Internal error")
+        return
+    for picture_id, (filename, *_) in zip(picture_ids, saved):
+        await build_renditions(picture_id, filename)
+
+
+async def remove_images(saved: list[tuple[str, int, str, str]]):
+    for filename, *_ in saved:
+        await run_in_threadpool(remove_file, filename)
+
+
+async def store_images(job_id: int, saved: list) -> list[int]:
+    """
+    Generate, download and store the images of the job.
+    :param saved: filled with the downloaded images - removed by the caller when the job fails
+    :return: ids of the stored pictures, empty when the job has failed
+    """
+    async with async_session_maker() as session:
+        job = await session.get(ImageJob, job_id)
+    if job is None:
+        return []
+    if not await set_status(job_id, "running"):
+        return []
+    async with prompt_limiter.slot(job.user_id):
+        urls = await openai_client.create_image(job.prompt, job.n, job.size, OPEN_AI_IMAGE_TIMEOUT)
+    saved.extend(await download_images(job_id, urls))
+    if not saved:
+        await set_status(job_id, "failed", error="No image could be downloaded", finished_at=datetime.utcnow())
+        return []
+    async with async_session_maker() as session:
+        pictures = [Picture(user_id=job.user_id, filename=filename, tag=job.tag, content_hash=content_hash,
+                            size=size, media_type=media_type)
+                    for filename, size, content_hash, media_type in saved]
+        session.add_all(pictures)
+        await session.flush()
+        picture_ids = [picture.id for picture in pictures]
+        job = await session.get(ImageJob, job_id)
+        job.status = "done"
+        job.picture_ids = picture_ids
+        job.finished_at = datetime.utcnow()
+        await session.commit()
+    return picture_ids
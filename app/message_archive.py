@@ -0,0 +1,97 @@
+import bisect
+import gzip
+import json
+from collections import OrderedDict
+from datetime import datetime
+
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+from starlette.concurrency import run_in_threadpool
+
+from app.models import MessageArchive
+from settings import MESSAGE_ARCHIVE_CACHE_SIZE
+
+
+class ArchiveSlice:
+    """ Parsed gzip member of an archive file - rows of one chat or author, ids ascending"""
+
+    def __init__(self, rows: list[dict]):
+        for row in rows:
+            row["created_at"] = datetime.fromisoformat(row["created_at"])
+        self.rows = rows
+        self.ids = [row["id"] for row in rows]
+
+    def newest(self, limit: int, before: int | None, since: datetime | None = None) -> list[dict]:
+        """ Up to limit rows with id < before, newest first"""
+        end = bisect.bisect_left(self.ids, before) if before is not None else len(self.ids)
+        found = []
+        for row in reversed(self.rows[:end]):
+            if since is not None and row["created_at"] < since:
+                # created_at is not ordered by id (imported history) - keep looking
+                continue
+            found.append(row)
+            if len(found) >= limit:
+                break
+        return found
+
+
+def load_slice(filename: str, offset: int, length: int) -> ArchiveSlice:
+    """ Only the member's bytes are read and decompressed, not the whole file"""
+    with open(filename, "rb") as buff:
+        buff.seek(offset)
+        data = buff.read(length)
+    return ArchiveSlice([json.loads(line) for line in gzip.decompress(data).decode("utf-8").splitlines()
+                         if line.strip()])
+
+
+class ArchiveReader:
+    """
+    Read path of archived message partitions - pages which reach into an archive read the member of
+    their chat (or author) only, the last `cache_size` members of the worker are kept parsed.
+    """
+
+    def __init__(self, cache_size: int = MESSAGE_ARCHIVE_CACHE_SIZE):
+        self.cache_size = cache_size
+        # (filename, offset) -> parsed member, least recently used first
+        self.loaded: OrderedDict[tuple[str, int], ArchiveSlice] = OrderedDict()
+
+    async def _load(self, filename: str, offset: int, length: int) -> ArchiveSlice:
+        key = (filename, offset)
+        archive_slice = self.loaded.get(key)
+        if archive_slice is None:
+            archive_slice = await run_in_threadpool(load_slice, filename, offset, length)
+            self.loaded[key] = archive_slice
+            while len(self.loaded) > self.cache_size:
+                self.loaded.popitem(last=False)
+        self.loaded.move_to_end(key)
+        return archive_slice
+
+    async def newest(self, session: AsyncSession, limit: int, before: int | None = None, floor: int | None = None,
+                     chat_id: int | None = None, author_id: int | None = None,
+                     since: datetime | None = None) -> list[dict]:
+        """
+        Up to limit archived messages of the chat (or author), newest (by id) first.
+        :param before: only ids below, the page cursor
+        :param floor: skip archives without ids above - nothing there can make it into the page
+        :param since: only messages created at or after
+        """
+        if chat_id is not None:
+            member = MessageArchive.chat_offsets[str(chat_id)]
+            statement = select(MessageArchive.filename, member).where(MessageArchive.chat_ids.any(chat_id))
+        else:
+            member = MessageArchive.author_offsets[str(author_id)]
+            statement = select(MessageArchive.filename, member).where(MessageArchive.author_ids.any(author_id))
+        if before is not None:
+            statement = statement.where(MessageArchive.min_id < before)
+        if floor is not None:
+            statement = statement.where(MessageArchive.max_id > floor)
+        if since is not None:
+            statement = statement.where(MessageArchive.range_end > since)
+        rows = []
+        for filename, (offset, length) in await session.execute(statement.order_by(MessageArchive.max_id.desc())):
+            archive_slice = await self._load(filename, offset, length)
+            rows.extend(archive_slice.newest(limit, before, since))
+        return sorted(rows, key=lambda row: row["id"], reverse=True)[:limit]
+
+
+archive_reader = ArchiveReader()
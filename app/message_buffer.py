@@ -0,0 +1,117 @@
+import asyncio
+import logging
+from collections import deque
+from datetime import datetime
+
+from sqlalchemy import insert
+
+from app.cache import invalidate, chat_tag, MESSAGES_NAMESPACE
+from app.chat_summary import record_messages, INSERTED_COLUMNS
+from app.db import async_session_maker
+from app.models import Message
+from settings import MESSAGE_BUFFER_SIZE, MESSAGE_BUFFER_INTERVAL, MESSAGE_BUFFER_LIMIT
+
+
+class MessageBuffer:
+    """
+    Write-behind buffer for chat messages.
+    add() only appends to memory, a background task writes the rows with one multi-row insert
+    when the buffer reaches max_size or every interval seconds, whichever comes first.
+    Chat summaries move in the same transaction.
+    """
+
+    def __init__(self, session_maker=async_session_maker, max_size: int = MESSAGE_BUFFER_SIZE,
+                 interval: float = MESSAGE_BUFFER_INTERVAL, limit: int = MESSAGE_BUFFER_LIMIT):
+        self.session_maker = session_maker
+        self.max_size = max_size
+        self.interval = interval
+        # Oldest rows are dropped past the limit, so a dead database can not eat all the memory
+        self.pending: deque[dict] = deque(maxlen=limit)
+        self.wakeup = asyncio.Event()
+        self.task: asyncio.Task | None = None
+        self.closing = False
+
+    def add(self, body: str, chat_id: int, author_id: int | None = None):
+        if len(self.pending) == self.pending.maxlen:
+            logging.warning("Message buffer is full, dropping the oldest message")
+        self.pending.append({"author_id": author_id,
+                             "body": body,
+                             "created_at": datetime.now(),
+                             "chat_id": chat_id})
+        if len(self.pending) >= self.max_size:
+            self.wakeup.set()
+
+    async def start(self):
+        if self.task is None:
+            self.task = asyncio.create_task(self._run())
+
+    async def _run(self):
+        while not self.closing:
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), timeout=self.interval)
+            except asyncio.TimeoutError:
+                pass
+            self.wakeup.clear()
+            try:
+                await self.flush()
+            except Exception as e:
+                # The writer must outlive any error - rows stay pending for the next tick
+                logging.error(f"Message buffer flush failed: >> {e} \n {self._run.__name__}")
+
+    async def flush(self):
+        while self.pending:
+            rows = [self.pending.popleft() for _ in range(min(self.max_size, len(self.pending)))]
+            try:
+                async with self.session_maker() as session:
+                    inserted = await session.execute(insert(Message).values(rows).returning(*INSERTED_COLUMNS))
+                    await record_messages(session, inserted.all())
+                    await session.commit()
+            except Exception as e:
+                logging.error(f"Message buffer write failed: >> {e} \n {self.flush.__name__}")
+                self.requeue(rows)
+                return
+            except asyncio.CancelledError:
+                self.requeue(rows)
+                raise
+            try:
+                await invalidate(MESSAGES_NAMESPACE, *{chat_tag(row["chat_id"]) for row in rows})
+            except Exception as e:
+                # Rows are committed - cached pages expire on their own
+                logging.error(f"Message cache invalidation failed: >> {e} \n {self.flush.__name__}")
+
+    def requeue(self, rows: list[dict]):
+        """
+        Put a failed batch back in front to retry on the next tick.
+        The batch is older than anything pending - past the limit its oldest rows are the ones dropped.
+        """
+        free = self.pending.maxlen - len(self.pending)
+        if len(rows) > free:
+            dropped = rows[:len(rows) - free]
+            rows = rows[len(rows) - free:]
+            logging.warning(f"Message buffer is full, dropped {len(dropped)} messages >> "
+                            f"chats {sorted({row['chat_id'] for row in dropped})}, "
+                            f"created {dropped[0]['created_at']} - {dropped[-1]['created_at']}")
+        self.pending.extendleft(reversed(rows))
+
+    async def close(self):
+        """
+        Stop the writer and flush what is pending - a failed flush is retried once,
+        rows still pending after that are lost (logged).
+        """
+        self.closing = True
+        self.wakeup.set()
+        if self.task is not None:
+            await self.task
+            self.task = None
+        for _ in range(2):
+            await self.flush()
+            if not self.pending:
+                return
+        rows = list(self.pending)
+        self.pending.clear()
+        logging.error(f"Message buffer closed with {len(rows)} unwritten messages, they are lost >> "
+                      f"chats {sorted({row['chat_id'] for row in rows})}, "
+                      f"created {rows[0]['created_at']} - {rows[-1]['created_at']}")
+
+
+message_buffer = MessageBuffer()
@@ -0,0 +1,319 @@
+"""
+Monthly partitions of message_table - made ahead of time, archived and dropped past the retention.
+Run once by hand:  python -m app.message_partitions maintain
+"""
+import asyncio
+import json
+import logging
+import os
+import re
+import sys
+import zlib
+from datetime import datetime, timedelta
+
+from sqlalchemy import select, delete, func, text, tuple_
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.exc import SQLAlchemyError, DBAPIError
+from starlette.concurrency import run_in_threadpool
+
+from app.db import async_session_maker
+from app.models import Message, MessageArchive, Reaction, ReactionCount
+from settings import MESSAGE_RETENTION_DAYS, MESSAGE_PARTITION_PREMAKE, MESSAGE_ARCHIVE_DIR, \
+    MESSAGE_MAINTENANCE_INTERVAL, MESSAGE_LOCK_TIMEOUT, MESSAGE_LOCK_RETRIES
+
+PARENT = Message.__tablename__
+PARTITION_RE = re.compile(rf"^{PARENT}_y(\d{{4}})m(\d{{2}})$")
+# pg advisory lock keys - partition DDL of the workers one at a time, one worker archives at a time
+MAINTENANCE_LOCK = 0x6d736770
+ARCHIVE_LOCK = 0x6d736761
+ARCHIVE_BATCH = 1000
+# SQLSTATE lock_not_available - lock_timeout ran out
+LOCK_NOT_AVAILABLE = "55P03"
+
+
+class PartitionChanged(Exception):
+    """ Partition or its reactions do not match the exported file - left for the next run"""
+
+
+def month_start(moment: datetime) -> datetime:
+    return datetime(moment.year, moment.month, 1)
+
+
+def add_months(start: datetime, months: int) -> datetime:
+    month = start.month - 1 + months
+    return datetime(start.year + month // 12, month % 12 + 1, 1)
+
+
+def partition_name(start: datetime) -> str:
+    return f"{PARENT}_y{start.year}m{start.month:02d}"
+
+
+class SectionWriter:
+    """ Rows of one key after another, each key a gzip member of its own - offsets[key] = [offset, length]"""
+
+    def __init__(self, buff):
+        self.buff = buff
+        self.offsets: dict[str, list[int]] = {}
+        self.key = None
+        self.start = 0
+        self.compressor = None
+
+    def write(self, key, lines: str):
+        if key != self.key:
+            self.finish()
+            self.key, self.start = key, self.buff.tell()
+            self.compressor = zlib.compressobj(wbits=31)
+        self.buff.write(self.compressor.compress(lines.encode("utf-8")))
+
+    def write_rows(self, rows: list[dict], field: str):
+        for row in rows:
+            self.write(row[field], json.dumps(row) + "\n")
+
+    def finish(self):
+        if self.compressor is None:
+            return
+        self.buff.write(self.compressor.flush())
+        self.offsets[str(self.key)] = [self.start, self.buff.tell() - self.start]
+        self.compressor = None
+
+
+class MessagePartitions:
+    """
+    Keeps monthly partitions of message_table: `premake` months ahead are always there,
+    partitions older than `retention_days` are written to a gzip NDJSON file with their reactions,
+    recorded as MessageArchive and dropped. retention_days 0 - nothing is archived.
+    """
+
+    def __init__(self, retention_days: int = MESSAGE_RETENTION_DAYS, premake: int = MESSAGE_PARTITION_PREMAKE,
+                 archive_dir: str = MESSAGE_ARCHIVE_DIR, interval: float = MESSAGE_MAINTENANCE_INTERVAL,
+                 lock_timeout: float = MESSAGE_LOCK_TIMEOUT, lock_retries: int = MESSAGE_LOCK_RETRIES):
+        self.retention_days = retention_days
+        self.premake = premake
+        self.archive_dir = archive_dir
+        self.interval = interval
+        self.lock_timeout = lock_timeout
+        self.lock_retries = lock_retries
+        # Partitions known to exist - ensure() skips the DDL for them
+        self.known: set[str] = set()
+        self.task: asyncio.Task | None = None
+
+    async def _with_lock_timeout(self, work):
+        """
+        Run work(session) in a transaction which gives up waiting for a lock after lock_timeout -
+        DDL waiting for ACCESS EXCLUSIVE would queue every query of the table behind it. Retried with a backoff.
+        """
+        for attempt in range(1, self.lock_retries + 1):
+            try:
+                async with async_session_maker() as session:
+                    await session.execute(text(f"SET LOCAL lock_timeout = {int(self.lock_timeout * 1000)}"))
+                    return await work(session)
+            except DBAPIError as e:
+                if getattr(e.orig, "sqlstate", None) != LOCK_NOT_AVAILABLE or attempt == self.lock_retries:
+                    raise
+                logging.warning(f"Message partition lock timeout, attempt {attempt} >> {work.__name__}")
+            await asyncio.sleep(self.lock_timeout * attempt)
+
+    async def partitions(self, session: AsyncSession) -> list[tuple[str, datetime, datetime]]:
+        """ (name, range start, range end) of every monthly partition, oldest first"""
+        results = await session.execute(text(
+            "SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid "
+            "WHERE i.inhparent = CAST(:parent AS regclass)"), {"parent": PARENT})
+        partitions = []
+        for name in results.scalars():
+            match = PARTITION_RE.match(name)
+            if match:
+                start = datetime(int(match.group(1)), int(match.group(2)), 1)
+                partitions.append((name, start, add_months(start, 1)))
+        return sorted(partitions, key=lambda partition: partition[1])
+
+    async def ensure(self, moments):
+        """ Partitions for every given created_at - made and committed in their own transaction"""
+        missing = {}
+        for start in {month_start(moment) for moment in moments}:
+            if partition_name(start) not in self.known:
+                missing[partition_name(start)] = start
+        if not missing:
+            return
+
+        async def create(session: AsyncSession):
+            await session.execute(text("SELECT pg_advisory_xact_lock(:key)"), {"key": MAINTENANCE_LOCK})
+            for name, start in sorted(missing.items()):
+                await session.execute(text(
+                    f"CREATE TABLE IF NOT EXISTS {name} PARTITION OF {PARENT} "
+                    f"FOR VALUES FROM ('{start.isoformat()}') TO ('{add_months(start, 1).isoformat()}')"))
+            await session.commit()
+
+        await self._with_lock_timeout(create)
+        self.known.update(missing)
+
+    async def premake_partitions(self):
+        current = month_start(datetime.now())
+        await self.ensure([add_months(current, months) for months in range(self.premake + 1)])
+
+    def _archive_path(self, name: str) -> str:
+        path = os.path.join(self.archive_dir, f"{name}.ndjson.gz")
+        if os.path.exists(path):
+            path = os.path.join(self.archive_dir, f"{name}_{int(datetime.now().timestamp())}.ndjson.gz")
+        return path
+
+    async def _rows(self, session: AsyncSession, start: datetime, end: datetime, key):
+        """ Messages of the range with their reactions, ordered by key (chat or author) and id, batch by batch"""
+        statement = select(Message).where(Message.created_at >= start).where(Message.created_at < end) \
+            .where(key.is_not(None)).order_by(key, Message.id).limit(ARCHIVE_BATCH)
+        last = None
+        while True:
+            batch = statement if last is None else statement.where(tuple_(key, Message.id) > last)
+            partition = (await session.execute(batch)).scalars().all()
+            if not partition:
+                return
+            last = (getattr(partition[-1], key.key), partition[-1].id)
+            ids = [message.id for message in partition]
+            reactions = (await session.execute(select(Reaction).where(Reaction.message_id.in_(ids)))).scalars()
+            by_message: dict[int, list] = {}
+            for reaction in reactions:
+                by_message.setdefault(reaction.message_id, []).append(
+                    {"id": reaction.id, "user_id": reaction.user_id, "type": reaction.type,
+                     "message_id": reaction.message_id})
+            rows = []
+            for message in partition:
+                message_reactions = by_message.get(message.id, [])
+                counts: dict[str, int] = {}
+                for reaction in message_reactions:
+                    counts[reaction["type"]] = counts.get(reaction["type"], 0) + 1
+                rows.append({"id": message.id, "author_id": message.author_id, "body": message.body,
+                             "created_at": message.created_at.isoformat(), "chat_id": message.chat_id,
+                             "source_id": message.source_id, "reactions": message_reactions, "reaction_counts": counts})
+            yield rows
+
+    @staticmethod
+    async def _snapshot(session: AsyncSession, name: str) -> tuple:
+        """ Row count and last id of the partition and of its reactions - any write moves one of them"""
+        messages = (await session.execute(text(f"SELECT count(*), max(id) FROM {name}"))).one()
+        in_partition = text(f"SELECT id FROM {name}").columns(Message.id)
+        reactions = (await session.execute(select(func.count(), func.max(Reaction.id))
+                                           .where(Reaction.message_id.in_(in_partition)))).one()
+        return tuple(messages) + tuple(reactions)
+
+    async def export(self, name: str, start: datetime, end: datetime) -> tuple[MessageArchive, tuple]:
+        """
+        Partition -> archive file, without any table lock: a member per chat, then a member per author.
+        :return: archive row to store and the snapshot the file was made from
+        """
+        os.makedirs(self.archive_dir, exist_ok=True)
+        path = self._archive_path(name)
+        archive = MessageArchive(partition=name, range_start=start, range_end=end, filename=path, rows=0)
+        buff = await run_in_threadpool(open, f"{path}.tmp", "wb")
+        try:
+            async with async_session_maker() as session:
+                # One snapshot for the snapshot numbers and both passes
+                await session.execute(text("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ"))
+                snapshot = await self._snapshot(session, name)
+                chats = SectionWriter(buff)
+                async for rows in self._rows(session, start, end, Message.chat_id):
+                    await run_in_threadpool(chats.write_rows, rows, "chat_id")
+                    ids = [row["id"] for row in rows]
+                    archive.rows += len(rows)
+                    archive.min_id = min(archive.min_id or ids[0], *ids)
+                    archive.max_id = max(archive.max_id or 0, *ids)
+                await run_in_threadpool(chats.finish)
+                authors = SectionWriter(buff)
+                async for rows in self._rows(session, start, end, Message.author_id):
+                    await run_in_threadpool(authors.write_rows, rows, "author_id")
+                await run_in_threadpool(authors.finish)
+            if archive.rows != snapshot[0]:
+                raise PartitionChanged(f"{name}: {snapshot[0] - archive.rows} messages without a chat")
+            await run_in_threadpool(buff.close)
+            await run_in_threadpool(os.replace, f"{path}.tmp", path)
+        except BaseException:
+            await run_in_threadpool(buff.close)
+            await run_in_threadpool(os.remove, f"{path}.tmp")
+            raise
+        archive.chat_offsets = chats.offsets
+        archive.author_offsets = authors.offsets
+        archive.chat_ids = sorted(int(chat_id) for chat_id in chats.offsets)
+        archive.author_ids = sorted(int(author_id) for author_id in authors.offsets)
+        return archive, snapshot
+
+    async def archive(self, name: str, start: datetime, end: datetime):
+        """
+        Partition -> archive file -> MessageArchive row, then its reactions and the partition are dropped.
+        The file is written first with no lock held; the drop is a short transaction under lock_timeout
+        which checks that nothing was written to the partition meanwhile.
+        """
+        archive, snapshot = await self.export(name, start, end)
+
+        async def drop(session: AsyncSession):
+            # Writes to the partition wait until the commit
+            await session.execute(text(f"LOCK TABLE {name} IN SHARE MODE"))
+            if await self._snapshot(session, name) != snapshot:
+                raise PartitionChanged(name)
+            in_partition = text(f"SELECT id FROM {name}").columns(Message.id)
+            await session.execute(delete(Reaction).where(Reaction.message_id.in_(in_partition)))
+            await session.execute(delete(ReactionCount).where(ReactionCount.message_id.in_(in_partition)))
+            if archive.rows:
+                session.add(archive)
+            await session.execute(text(f"ALTER TABLE {PARENT} DETACH PARTITION {name}"))
+            await session.execute(text(f"DROP TABLE {name}"))
+            await session.commit()
+
+        try:
+            await self._with_lock_timeout(drop)
+        except BaseException:
+            await run_in_threadpool(os.remove, archive.filename)
+            raise
+        self.known.discard(name)
+        if not archive.rows:
+            await run_in_threadpool(os.remove, archive.filename)
+        logging.info(f"Archived message partition {name} >> {archive.rows} rows to {archive.filename}")
+
+    async def maintain(self):
+        """ Make the partitions ahead, archive the expired ones - archiving is skipped while another worker is on it"""
+        await self.premake_partitions()
+        if self.retention_days <= 0:
+            return
+        horizon = datetime.now() - timedelta(days=self.retention_days)
+        # The guard transaction only holds the advisory lock, it touches no table
+        async with async_session_maker() as guard:
+            locked = await guard.scalar(text("SELECT pg_try_advisory_xact_lock(:key)"), {"key": ARCHIVE_LOCK})
+            if not locked:
+                return
+            async with async_session_maker() as session:
+                expired = [partition for partition in await self.partitions(session) if partition[2] <= horizon]
+            for name, start, end in expired:
+                try:
+                    await self.archive(name, start, end)
+                except PartitionChanged:
+                    logging.warning(f"Message partition {name} changed while archived, next run takes it")
+
+    async def start(self):
+        """ Partitions of this month and the next ones right away, the rest in the background"""
+        try:
+            await self.premake_partitions()
+        except SQLAlchemyError as e:
+            logging.error(f"SQLAlchemyError: >> {e} \n {self.start.__name__}")
+        if self.task is None:
+            self.task = asyncio.create_task(self._run())
+
+    async def _run(self):
+        while True:
+            try:
+                await self.maintain()
+            except Exception as e:
+                # The loop must outlive any error - the next run tries again
+                logging.error(f"Message partition maintenance failed: >> {e} \n {self.maintain.__name__}")
+            await asyncio.sleep(self.interval)
+
+    async def close(self):
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+
+
+message_partitions = MessagePartitions()
+
+
+if __name__ == "__main__":
+    if sys.argv[1:] != ["maintain"]:
+        sys.exit("usage: python -m app.message_partitions maintain")
+    asyncio.run(message_partitions.maintain())
+    print("Message partitions maintained")
@@ -1,8 +1,10 @@
+from datetime import datetime
 from typing import List
 
 from fastapi_users.db import SQLAlchemyUserDatabase
 from fastapi_users_db_sqlalchemy import SQLAlchemyBaseUserTable
-from sqlalchemy import Integer, String, ForeignKey, Text, Boolean, DateTime, Table, Column,LargeBinary
+from sqlalchemy import Integer, BigInteger, String, ForeignKey, Text, Boolean, DateTime, Table, Column,LargeBinary, Index, UniqueConstraint, Computed, func
+from sqlalchemy.dialects.postgresql import TSVECTOR, ARRAY, JSONB
 from sqlalchemy.orm import DeclarativeBase, relationship, Mapped, mapped_column
 
 
@@ -45,44 +47,197 @@ class Picture(Base):
     user_id: Mapped[int] = mapped_column(ForeignKey("user_table.id"), nullable=False)
     filename: Mapped[str] = mapped_column(Text,nullable=False)
     tag: Mapped[str] = mapped_column(String)
+    # sha256 hex digest and size in bytes - computed while the upload streams to disk
+    content_hash: Mapped[str] = mapped_column(String(64), nullable=True)
+    size: Mapped[int] = mapped_column(Integer, nullable=True)
+    # Detected once on upload from the file signature
+    media_type: Mapped[str] = mapped_column(String, nullable=True)
     # Picture.user - backref
 
     def __repr__(self):
         return f"Picture_id={self.id}, user={self.user_id} tag={self.tag})"
 
 
+class PictureRendition(Base):
+    """
+    Scaled down copy of a picture (thumbnail, medium, large ...) made once after upload.
+    """
+    __tablename__ = "picture_rendition_table"
+    __table_args__ = (
+        UniqueConstraint("picture_id", "name", name="uq_rendition_picture_name"),
+    )
+    id: Mapped[int] = mapped_column(primary_key=True)
+    picture_id: Mapped[int] = mapped_column(ForeignKey("picture_table.id", ondelete="CASCADE"), nullable=False)
+    name: Mapped[str] = mapped_column(String, nullable=False)
+    filename: Mapped[str] = mapped_column(Text, nullable=False)
+    media_type: Mapped[str] = mapped_column(String, nullable=False)
+    width: Mapped[int] = mapped_column(Integer)
+    height: Mapped[int] = mapped_column(Integer)
+    size: Mapped[int] = mapped_column(Integer)
+
+    def __repr__(self):
+        return f"PictureRendition picture={self.picture_id}, name={self.name}, {self.width}x{self.height}"
+
+
+class ImageJob(Base):
+    """
+    Image generation (DALL·E) job - created by the request, run in the background,
+    the generated images are stored as Picture rows.
+    """
+    __tablename__ = "image_job_table"
+    # created_at comes back with the INSERT, the job is returned right after commit
+    __mapper_args__ = {"eager_defaults": True}
+    id: Mapped[int] = mapped_column(primary_key=True)
+    user_id: Mapped[int] = mapped_column(ForeignKey("user_table.id"), nullable=False, index=True)
+    prompt: Mapped[str] = mapped_column(Text, nullable=False)
+    size: Mapped[str] = mapped_column(String, nullable=False)
+    n: Mapped[int] = mapped_column(Integer, nullable=False)
+    tag: Mapped[str] = mapped_column(String)
+    # pending -> running -> done | failed
+    status: Mapped[str] = mapped_column(String, nullable=False, default="pending")
+    error: Mapped[str] = mapped_column(Text, nullable=True)
+    picture_ids: Mapped[List[int]] = mapped_column(ARRAY(Integer), nullable=True)
+    created_at: Mapped[datetime] = mapped_column(DateTime, server_default=func.now())
+    finished_at: Mapped[datetime] = mapped_column(DateTime, nullable=True)
+
+    def __repr__(self):
+        return f"ImageJob id={self.id}, user={self.user_id}, status={self.status}"
+
+
 class Reaction(Base):
     """
     Reaction model - which shows user who reacted to a picture or chat message.
     Type field should contain the type of the reaction like "like" or "dislike".
     """
     __tablename__ = "reaction_table"
+    __table_args__ = (
+        # One reaction per user and message - add_reaction upserts against it
+        UniqueConstraint("user_id", "message_id", name="uq_reaction_user_message"),
+    )
     id: Mapped[int] = mapped_column(Integer, primary_key=True)
     user_id: Mapped[int] = mapped_column(ForeignKey("user_table.id"), nullable=True)
     type: Mapped[str] = mapped_column(String, nullable=True)
-    message_id: Mapped[int] = mapped_column(ForeignKey("message_table.id"), nullable=True)
+    # No foreign key - message_table is partitioned by created_at, its rows are unique by (id, created_at)
+    message_id: Mapped[int] = mapped_column(Integer, nullable=True, index=True)
 
     def __repr__(self):
         return f"Reaction_id={self.id}, user={self.user_id}, type={self.type}"
 
 
+class ReactionCount(Base):
+    """
+    Reaction counters per message and reaction type - kept up to date by add / delete reaction methods.
+    """
+    __tablename__ = "reaction_count_table"
+    message_id: Mapped[int] = mapped_column(Integer, primary_key=True)
+    type: Mapped[str] = mapped_column(String, primary_key=True)
+    count: Mapped[int] = mapped_column(Integer, nullable=False, default=0)
+
+    def __repr__(self):
+        return f"ReactionCount message={self.message_id}, type={self.type}, count={self.count}"
+
+
 class Message(Base):
     """
     Message Table which contains text messages related to the chat and of course users who participating in the chat
     """
     __tablename__ = "message_table"
-    id: Mapped[int] = mapped_column(primary_key=True)
+    __table_args__ = (
+        # Keyset pagination: WHERE chat_id = ? AND id < ? ORDER BY id DESC
+        Index("ix_message_chat_id_id", "chat_id", "id"),
+        Index("ix_message_author_id_id", "author_id", "id"),
+        # "messages since T" in a chat
+        Index("ix_message_chat_id_created_at", "chat_id", "created_at"),
+        # Imported history: a message of the source system is stored once
+        UniqueConstraint("source_id", "created_at", name="uq_message_source_id_created_at"),
+        # Monthly partitions, made and archived by app.message_partitions
+        {"postgresql_partition_by": "RANGE (created_at)"},
+    )
+    # The partition key has to be a part of the primary key, ids still come from one sequence
+    id: Mapped[int] = mapped_column(Integer, primary_key=True, autoincrement=True)
     author_id: Mapped[int] = mapped_column(ForeignKey("user_table.id"), nullable=True)
     body: Mapped[str] = mapped_column(Text)
-    created_at: Mapped[str] = mapped_column(Text, nullable=False)
-    reactions: Mapped["Reaction"] = relationship(backref='message', lazy='joined', uselist=True)
-    chat_id: Mapped[int] = mapped_column(Integer, default=None)
+    created_at: Mapped[datetime] = mapped_column(DateTime, primary_key=True, server_default=func.now())
+    # Loaded only on request (selectinload) - see ReactionLoading in message endpoints
+    reactions: Mapped["Reaction"] = relationship(primaryjoin="Message.id == foreign(Reaction.message_id)",
+                                                 viewonly=True, lazy='raise', uselist=True)
+    # BigInteger - web socket chat ids are millisecond timestamps
+    chat_id: Mapped[int] = mapped_column(BigInteger, default=None)
+    # Id in the system an imported message comes from, NULL for messages written here
+    source_id: Mapped[str] = mapped_column(String(255), nullable=True)
 
     def __repr__(self):
         return f"Message_id={self.id}, author={self.author_id}, chat_id={self.chat_id}"
 
 
 
+class ChatSummary(Base):
+    """
+    Chat list state - last message and message count per chat, moved by every message insert
+    (app.chat_summary), so the inbox never scans message_table.
+    """
+    __tablename__ = "chat_summary_table"
+    chat_id: Mapped[int] = mapped_column(BigInteger, primary_key=True)
+    message_count: Mapped[int] = mapped_column(Integer, nullable=False, default=0)
+    last_message_id: Mapped[int] = mapped_column(Integer, nullable=False)
+    last_author_id: Mapped[int] = mapped_column(Integer, nullable=True)
+    last_body: Mapped[str] = mapped_column(Text, nullable=True)
+    last_created_at: Mapped[datetime] = mapped_column(DateTime, nullable=True)
+
+    def __repr__(self):
+        return f"ChatSummary chat={self.chat_id}, messages={self.message_count}, last={self.last_message_id}"
+
+
+class ChatMember(Base):
+    """
+    User in a chat - joined by writing to it or by reading it.
+    read_count is the chat message_count at the read position, unread = message_count - read_count,
+    so an insert never touches the other members.
+    """
+    __tablename__ = "chat_member_table"
+    __table_args__ = (
+        # Inbox: WHERE user_id = ?
+        Index("ix_chat_member_user_id_chat_id", "user_id", "chat_id"),
+    )
+    chat_id: Mapped[int] = mapped_column(BigInteger, primary_key=True)
+    user_id: Mapped[int] = mapped_column(ForeignKey("user_table.id"), primary_key=True)
+    last_read_id: Mapped[int] = mapped_column(Integer, nullable=False, default=0)
+    read_count: Mapped[int] = mapped_column(Integer, nullable=False, default=0)
+
+    def __repr__(self):
+        return f"ChatMember chat={self.chat_id}, user={self.user_id}, read={self.read_count}"
+
+
+class MessageArchive(Base):
+    """
+    Message partition moved out of the database - gzip NDJSON file with the messages of
+    [range_start, range_end) and their reactions, read back on demand by app.message_archive.
+    The file is one gzip member per chat, then one per author (every row is there twice),
+    a page decompresses only the member of its chat or author.
+    """
+    __tablename__ = "message_archive_table"
+    id: Mapped[int] = mapped_column(primary_key=True)
+    # A range archived again (old history imported after archiving) gets one more row
+    partition: Mapped[str] = mapped_column(String, nullable=False, index=True)
+    range_start: Mapped[datetime] = mapped_column(DateTime, nullable=False)
+    range_end: Mapped[datetime] = mapped_column(DateTime, nullable=False)
+    filename: Mapped[str] = mapped_column(Text, nullable=False)
+    rows: Mapped[int] = mapped_column(Integer, nullable=False)
+    # Id bounds - a page only opens the archives which can hold ids below its cursor
+    min_id: Mapped[int] = mapped_column(Integer, nullable=True)
+    max_id: Mapped[int] = mapped_column(Integer, nullable=True)
+    # Chats and authors present in the file - pages of other chats never open it
+    chat_ids: Mapped[List[int]] = mapped_column(ARRAY(BigInteger), nullable=False, default=list)
+    author_ids: Mapped[List[int]] = mapped_column(ARRAY(Integer), nullable=False, default=list)
+    # "chat_id" / "author_id" -> [offset, length] of its gzip member in the file
+    chat_offsets: Mapped[dict] = mapped_column(JSONB, nullable=False, default=dict)
+    author_offsets: Mapped[dict] = mapped_column(JSONB, nullable=False, default=dict)
+    archived_at: Mapped[datetime] = mapped_column(DateTime, server_default=func.now())
+
+    def __repr__(self):
+        return f"MessageArchive {self.partition}, rows={self.rows}"
+
+
 # class ContactList(Base):
 #     "Продумай Контакт Лист и Методы ..."
 #     __tablename__ = 'contact_table'
@@ -124,6 +279,14 @@ class Artist(Base):
 class Release(Base):
     """Release - table which contains artists album """
     __tablename__ = "release_table"
+    __table_args__ = (
+        # Full text search with ranking and prefix matching
+        Index("ix_release_search_vector", "search_vector", postgresql_using="gin"),
+        # Typo tolerant matching - needs the pg_trgm extension
+        Index("ix_release_name_trgm", "name", postgresql_using="gin", postgresql_ops={"name": "gin_trgm_ops"}),
+        Index("ix_release_artists_trgm", "artists", postgresql_using="gin",
+              postgresql_ops={"artists": "gin_trgm_ops"}),
+    )
     id: Mapped[int] = mapped_column(primary_key=True)
     author_id: Mapped[int] = mapped_column(ForeignKey("user_table.id"), nullable=True)
     name: Mapped[str] = mapped_column(Text)
@@ -134,6 +297,25 @@ class Release(Base):
     record_label: Mapped[str] = mapped_column(Text)
     filename: Mapped[str] = mapped_column(Text, nullable=False)
     cover_id: Mapped[int] = mapped_column(Integer)
+    # Weighted tsvector kept by Postgres - name and artists first, genre and label next, story last
+    search_vector: Mapped[str] = mapped_column(TSVECTOR, Computed(
+        "setweight(to_tsvector('simple', coalesce(name, '') || ' ' || coalesce(artists, '')), 'A') || "
+        "setweight(to_tsvector('simple', coalesce(genre, '') || ' ' || coalesce(record_label, '')), 'B') || "
+        "setweight(to_tsvector('simple', coalesce(story_text, '')), 'C')",
+        persisted=True), deferred=True)
+
+    def __repr__(self):
+        return f"release_id={self.id}, name={self.name}, artists={self.artists}, release_date={self.release_date}"
+
+class ReleaseStat(Base):
+    """
+    Release counters per dimension (genre, record_label, month) and bucket - kept up to date
+    by add / delete release methods, rebuilt from scratch by app.release_stats.
+    """
+    __tablename__ = "release_stat_table"
+    dimension: Mapped[str] = mapped_column(String, primary_key=True)
+    bucket: Mapped[str] = mapped_column(Text, primary_key=True)
+    count: Mapped[int] = mapped_column(Integer, nullable=False, default=0)
 
     def __repr__(self):
-        return f"release_id={self.id}, name={self.name}, artists={self.artists}, release_date={self.release_date}"
\ No newline at end of file
+        return f"ReleaseStat {self.dimension}={self.bucket}, count={self.count}"
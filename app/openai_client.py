@@ -0,0 +1,151 @@
+import asyncio
+import json
+from contextlib import contextmanager
+from typing import AsyncIterator
+
+import aiohttp
+
+from settings import OPEN_AI_API_KEY, OPEN_AI_ENGINE, OPEN_AI_BASE_URL, OPEN_AI_TIMEOUT, \
+    OPEN_AI_MAX_CONCURRENCY, OPEN_AI_POOL_SIZE
+
+
+class OpenAIError(Exception):
+    """ Upstream answered with an error status, could not be reached or sent a broken stream (status 0)"""
+
+    def __init__(self, status: int, message: str):
+        super().__init__(message)
+        self.status = status
+        self.message = message
+
+
+@contextmanager
+def client_errors():
+    """ aiohttp connection and payload errors -> OpenAIError, timeouts stay asyncio.TimeoutError"""
+    try:
+        yield
+    except aiohttp.ClientError as e:
+        if isinstance(e, asyncio.TimeoutError):
+            raise
+        raise OpenAIError(0, f"OpenAI connection failed: {e!r}") from e
+
+
+class OpenAIClient:
+    """
+    Async OpenAI HTTP client - one shared connection pool, per call timeouts
+    and a global limit of concurrent upstream calls.
+    Talks to base_url, so tests can run it against a local stub of the completion API.
+    """
+
+    def __init__(self, api_key: str = OPEN_AI_API_KEY, base_url: str = OPEN_AI_BASE_URL,
+                 timeout: float = OPEN_AI_TIMEOUT, max_concurrency: int = OPEN_AI_MAX_CONCURRENCY,
+                 pool_size: int = OPEN_AI_POOL_SIZE):
+        self.api_key = api_key
+        self.base_url = base_url.rstrip("/")
+        self.timeout = timeout
+        self.max_concurrency = max_concurrency
+        self.pool_size = pool_size
+        self.session: aiohttp.ClientSession | None = None
+        self.semaphore: asyncio.Semaphore | None = None
+
+    def _session(self) -> aiohttp.ClientSession:
+        if self.session is None or self.session.closed:
+            # No default headers - the API key must not go to image download hosts
+            self.session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=self.pool_size))
+            self.semaphore = asyncio.Semaphore(self.max_concurrency)
+        return self.session
+
+    def _headers(self) -> dict:
+        return {"Authorization": f"Bearer {self.api_key}"}
+
+    def _timeout(self, timeout: float | None) -> aiohttp.ClientTimeout:
+        return aiohttp.ClientTimeout(total=timeout or self.timeout)
+
+    @staticmethod
+    async def _check(response: aiohttp.ClientResponse):
+        if response.status >= 400:
+            text = await response.text()
+            try:
+                message = json.loads(text)["error"]["message"]
+            except (ValueError, KeyError, TypeError):
+                message = text
+            raise OpenAIError(response.status, message)
+
+    @staticmethod
+    def _chunk_text(data: str) -> str:
+        """ Text of one stream event - an error event or a malformed one is an OpenAIError"""
+        try:
+            chunk = json.loads(data)
+        except ValueError:
+            raise OpenAIError(0, f"Malformed stream chunk: {data[:200]}")
+        try:
+            return chunk["choices"][0]["text"]
+        except (KeyError, IndexError, TypeError):
+            try:
+                message = chunk["error"]["message"]
+            except (KeyError, TypeError):
+                message = f"Malformed stream chunk: {data[:200]}"
+            raise OpenAIError(0, message)
+
+    async def request(self, method: str, path: str, payload: dict | None = None, timeout: float | None = None) -> dict:
+        session = self._session()
+        async with self.semaphore:
+            with client_errors():
+                async with session.request(method, f"{self.base_url}{path}", json=payload, headers=self._headers(),
+                                           timeout=self._timeout(timeout)) as response:
+                    await self._check(response)
+                    return await response.json()
+
+    async def completion(self, prompt: str, engine: str = OPEN_AI_ENGINE, timeout: float | None = None,
+                         **params) -> dict:
+        """ Whole completion response - choices and token usage"""
+        return await self.request("POST", "/completions", {"model": engine, "prompt": prompt, **params}, timeout)
+
+    async def complete(self, prompt: str, engine: str = OPEN_AI_ENGINE, timeout: float | None = None,
+                       **params) -> str:
+        """ Completion text for the prompt"""
+        result = await self.completion(prompt, engine, timeout, **params)
+        return result["choices"][0]["text"]
+
+    async def stream(self, prompt: str, engine: str = OPEN_AI_ENGINE, timeout: float | None = None,
+                     **params) -> AsyncIterator[str]:
+        """ Completion text pieces as the upstream sends them (stream=true server-sent events)"""
+        session = self._session()
+        payload = {"model": engine, "prompt": prompt, "stream": True, **params}
+        async with self.semaphore:
+            with client_errors():
+                async with session.post(f"{self.base_url}/completions", json=payload, headers=self._headers(),
+                                        timeout=self._timeout(timeout)) as response:
+                    await self._check(response)
+                    async for line in response.content:
+                        line = line.decode().strip()
+                        if not line.startswith("data:"):
+                            continue
+                        data = line[len("data:"):].strip()
+                        if data == "[DONE]":
+                            return
+                        yield self._chunk_text(data)
+
+    async def create_image(self, prompt: str, n: int, size: str, timeout: float | None = None) -> list[str]:
+        """ URLs of the generated images (DALL·E)"""
+        result = await self.request("POST", "/images/generations", {"prompt": prompt, "n": n, "size": size}, timeout)
+        return [image["url"] for image in result["data"]]
+
+    async def download(self, url: str, chunk_size: int, timeout: float | None = None) -> AsyncIterator[bytes]:
+        """ File behind a URL chunk by chunk - sent without the API key, outside the upstream call limit"""
+        with client_errors():
+            async with self._session().get(url, timeout=self._timeout(timeout)) as response:
+                if response.status >= 400:
+                    raise OpenAIError(response.status, f"Download failed: {url}")
+                async for chunk in response.content.iter_chunked(chunk_size):
+                    yield chunk
+
+    async def list_models(self, timeout: float | None = None) -> list:
+        return (await self.request("GET", "/models", timeout=timeout))["data"]
+
+    async def close(self):
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+
+
+openai_client = OpenAIClient()
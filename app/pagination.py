@@ -0,0 +1,30 @@
+import base64
+import binascii
+
+from fastapi import HTTPException
+from starlette import status
+
+
+def encode_cursor(last_id: int) -> str:
+    """ Opaque cursor which points right after the row with last_id"""
+    return base64.urlsafe_b64encode(str(last_id).encode()).decode()
+
+
+def decode_cursor(cursor: str) -> int:
+    try:
+        return int(base64.urlsafe_b64decode(cursor.encode()).decode())
+    except (binascii.Error, UnicodeDecodeError, ValueError):
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Invalid cursor")
+
+
+def paginate(instances: list, limit: int) -> tuple[list, str | None]:
+    """
+    Cut one page out of limit + 1 fetched rows.
+    :param instances: rows ordered by the keyset column, at most limit + 1
+    :param limit: page size
+    :return: page rows and cursor of the next page (None on the last page)
+    """
+    if len(instances) <= limit:
+        return list(instances), None
+    page = list(instances[:limit])
+    return page, encode_cursor(page[-1].id)
@@ -0,0 +1,64 @@
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from fastapi_users.password import PasswordHelper
+from passlib.context import CryptContext
+
+from settings import PASSWORD_BCRYPT_ROUNDS, PASSWORD_HASH_WORKERS
+
+
+class PasswordHasher(PasswordHelper):
+    """
+    fastapi-users password helper which hashes and verifies in a dedicated thread pool.
+    At most `workers` hashes run at once, the rest queue - see metrics().
+    Hashes below the configured bcrypt cost are reported as outdated by verify_and_update_async.
+    """
+
+    def __init__(self, rounds: int = PASSWORD_BCRYPT_ROUNDS, workers: int = PASSWORD_HASH_WORKERS):
+        super().__init__(CryptContext(schemes=["bcrypt"], deprecated="auto",
+                                      bcrypt__default_rounds=rounds, bcrypt__min_rounds=rounds))
+        self.workers = workers
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="password-hash")
+        self.semaphore: asyncio.Semaphore | None = None
+        self.waiting = 0
+        self.running = 0
+        self.calls = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+    async def _run(self, func, *args):
+        if self.semaphore is None:
+            self.semaphore = asyncio.Semaphore(self.workers)
+        self.waiting += 1
+        started = time.perf_counter()
+        async with self.semaphore:
+            waited = time.perf_counter() - started
+            self.waiting -= 1
+            self.calls += 1
+            self.wait_total += waited
+            self.wait_max = max(self.wait_max, waited)
+            self.running += 1
+            try:
+                return await asyncio.get_running_loop().run_in_executor(self.executor, func, *args)
+            finally:
+                self.running -= 1
+
+    async def hash_async(self, password: str) -> str:
+        return await self._run(self.context.hash, password)
+
+    async def verify_and_update_async(self, plain_password: str, hashed_password: str) -> tuple[bool, str | None]:
+        return await self._run(self.context.verify_and_update, plain_password, hashed_password)
+
+    def metrics(self) -> dict:
+        return {
+            "workers": self.workers,
+            "running": self.running,
+            "waiting": self.waiting,
+            "calls": self.calls,
+            "wait_avg_ms": round(self.wait_total / self.calls * 1000, 3) if self.calls else 0.0,
+            "wait_max_ms": round(self.wait_max * 1000, 3),
+        }
+
+
+password_hasher = PasswordHasher()
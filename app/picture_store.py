@@ -0,0 +1,75 @@
+import hashlib
+import mimetypes
+import os
+import tempfile
+import uuid
+from typing import AsyncIterator
+
+from starlette.concurrency import run_in_threadpool
+
+from app.file_response import sniff_media_type
+from settings import PICTURE_MAX_SIZE
+
+
+class PictureTooLarge(ValueError):
+    pass
+
+
+def guess_media_type(path: str) -> str:
+    return mimetypes.guess_type(path)[0] or "application/octet-stream"
+
+
+def remove_file(path: str):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+def picture_name(original: str, media_type: str | None) -> str:
+    """ Unique file name - extension of the media type, or of the original name when the type is unknown"""
+    extension = mimetypes.guess_extension(media_type) if media_type else None
+    if extension is None:
+        extension = os.path.splitext(original)[1].lower()
+        extension = extension if extension[1:].isalnum() else ""
+    return f"{uuid.uuid4().hex}{extension}"
+
+
+def open_temp(directory: str):
+    handle, path = tempfile.mkstemp(dir=directory, suffix=".part")
+    return os.fdopen(handle, "wb"), path
+
+
+async def save_chunks(chunks: AsyncIterator[bytes], directory: str, original: str = "") -> tuple[str, int, str, str]:
+    """
+    Write picture chunks to a temp file in the directory as they come, file writes run in the thread pool.
+    Only a complete picture is moved to its own unique name - a failed save never touches other files.
+    Shared by uploads and downloaded (generated) pictures.
+    :param chunks: picture bytes
+    :param directory: destination directory
+    :param original: original file name, only its extension is kept
+    :return: path, size in bytes, sha256 hex digest and media type
+    :raises PictureTooLarge: when the picture is larger than PICTURE_MAX_SIZE
+    """
+    digest = hashlib.sha256()
+    size = 0
+    media_type = None
+    buff, temp_path = await run_in_threadpool(open_temp, directory)
+    try:
+        async for chunk in chunks:
+            size += len(chunk)
+            if size > PICTURE_MAX_SIZE:
+                raise PictureTooLarge(f"Picture is larger than {PICTURE_MAX_SIZE} bytes")
+            if media_type is None:
+                media_type = sniff_media_type(chunk) or guess_media_type(original)
+            digest.update(chunk)
+            await run_in_threadpool(buff.write, chunk)
+        await run_in_threadpool(buff.close)
+        media_type = media_type or guess_media_type(original)
+        path = os.path.join(directory, picture_name(original, media_type))
+        await run_in_threadpool(os.replace, temp_path, path)
+    except BaseException:
+        await run_in_threadpool(buff.close)
+        await run_in_threadpool(remove_file, temp_path)
+        raise
+    return path, size, digest.hexdigest(), media_type
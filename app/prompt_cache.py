@@ -0,0 +1,142 @@
+import asyncio
+import hashlib
+import json
+import logging
+import time
+from collections import Counter, OrderedDict
+from typing import Awaitable, Callable
+
+from app.openai_client import openai_client
+from settings import PROMPT_CACHE_TTL, PROMPT_CACHE_SIZE, OPEN_AI_MODELS_REFRESH
+
+
+def normalize_prompt(prompt: str) -> str:
+    """ Whitespace runs collapsed and ends stripped - case is kept, it changes the answer"""
+    return " ".join(prompt.split())
+
+
+def prompt_key(prompt: str, engine: str, params: dict) -> str:
+    raw = json.dumps([normalize_prompt(prompt), engine, params], sort_keys=True, default=str)
+    return hashlib.sha256(raw.encode()).hexdigest()
+
+
+class PromptCache:
+    """
+    Per worker TTL/LRU cache of completion results, keyed by normalized prompt, engine and parameters.
+    Concurrent callers of the same key share one upstream call, failures are not cached.
+    """
+
+    def __init__(self, ttl: float = PROMPT_CACHE_TTL, max_size: int = PROMPT_CACHE_SIZE):
+        self.ttl = ttl
+        self.max_size = max_size
+        # key -> (expires at, result), least recently used first
+        self.entries: OrderedDict[str, tuple[float, str]] = OrderedDict()
+        # key -> upstream call shared by the waiting callers
+        self.in_flight: dict[str, asyncio.Task] = {}
+        # hits, misses, coalesced
+        self.counters = Counter()
+
+    def _get(self, key: str) -> str | None:
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        expires, result = entry
+        if time.monotonic() >= expires:
+            del self.entries[key]
+            return None
+        self.entries.move_to_end(key)
+        return result
+
+    def _set(self, key: str, result: str):
+        if self.ttl <= 0:
+            return
+        self.entries[key] = (time.monotonic() + self.ttl, result)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    async def get_or_call(self, key: str, call: Callable[[], Awaitable[str]]) -> str:
+        """
+        Cached result of the key or the result of call().
+        :param key: prompt_key(...)
+        :param call: upstream call, made at most once at a time per key
+        """
+        result = self._get(key)
+        if result is not None:
+            self.counters["hits"] += 1
+            return result
+        task = self.in_flight.get(key)
+        if task is None:
+            self.counters["misses"] += 1
+            task = asyncio.create_task(self._call(key, call))
+            self.in_flight[key] = task
+        else:
+            self.counters["coalesced"] += 1
+        # A cancelled caller does not cancel the call the others wait for
+        return await asyncio.shield(task)
+
+    async def _call(self, key: str, call: Callable[[], Awaitable[str]]) -> str:
+        try:
+            result = await call()
+            self._set(key, result)
+            return result
+        finally:
+            self.in_flight.pop(key, None)
+
+    def metrics(self) -> dict:
+        return {"entries": len(self.entries), "in_flight": len(self.in_flight), **self.counters}
+
+
+class ModelListCache:
+    """
+    Upstream model list, fetched once and refreshed in the background every refresh seconds.
+    A failed refresh keeps serving the previous list.
+    """
+
+    def __init__(self, fetch: Callable[[], Awaitable[list]], refresh: float = OPEN_AI_MODELS_REFRESH):
+        self.fetch = fetch
+        self.refresh = refresh
+        self.models: list | None = None
+        self.fetched_at: float | None = None
+        self.loading: asyncio.Task | None = None
+        self.refresher: asyncio.Task | None = None
+
+    async def _load(self) -> list:
+        try:
+            self.models = await self.fetch()
+            self.fetched_at = time.time()
+            return self.models
+        finally:
+            self.loading = None
+
+    async def get(self) -> list:
+        if self.models is not None:
+            return self.models
+        if self.loading is None:
+            self.loading = asyncio.create_task(self._load())
+        return await asyncio.shield(self.loading)
+
+    def start(self):
+        if self.refresh > 0 and self.refresher is None:
+            self.refresher = asyncio.create_task(self._refresh())
+
+    async def close(self):
+        if self.refresher is not None:
+            self.refresher.cancel()
+            self.refresher = None
+
+    async def _refresh(self):
+        while True:
+            try:
+                if self.loading is None:
+                    self.loading = asyncio.create_task(self._load())
+                await asyncio.shield(self.loading)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logging.error(f"Model list refresh failed: >> {e} \n {self._refresh.__name__}")
+            await asyncio.sleep(self.refresh)
+
+
+prompt_cache = PromptCache()
+model_list = ModelListCache(openai_client.list_models)
@@ -0,0 +1,74 @@
+import asyncio
+import time
+from collections import defaultdict, deque
+from contextlib import asynccontextmanager
+
+from settings import PROMPT_USER_CONCURRENCY, PROMPT_TOKEN_BUDGET, PROMPT_TOKEN_WINDOW
+
+
+def estimate_tokens(text: str) -> int:
+    """ Rough token count (~4 characters a token) where the upstream reports no usage"""
+    return max(1, len(text) // 4)
+
+
+class PromptLimiter:
+    """
+    Per worker fairness for upstream prompts - at most `concurrency` calls of one user at a time
+    and at most `budget` tokens per user in any rolling `window` seconds (budget 0 - unlimited).
+    Only upstream calls spend tokens, prompt cache hits are free. The budget is checked before a call,
+    so calls already in flight can overshoot it by at most `concurrency` calls.
+    """
+
+    def __init__(self, concurrency: int = PROMPT_USER_CONCURRENCY, budget: int = PROMPT_TOKEN_BUDGET,
+                 window: float = PROMPT_TOKEN_WINDOW):
+        self.concurrency = concurrency
+        self.budget = budget
+        self.window = window
+        self.semaphores: dict[int, asyncio.Semaphore] = {}
+        # user_id -> callers holding or waiting for a slot, the semaphore is dropped at 0
+        self.users: dict[int, int] = defaultdict(int)
+        # user_id -> (spent at, tokens), oldest first
+        self.spent: dict[int, deque] = defaultdict(deque)
+
+    @asynccontextmanager
+    async def slot(self, user_id: int):
+        semaphore = self.semaphores.get(user_id)
+        if semaphore is None:
+            semaphore = self.semaphores[user_id] = asyncio.Semaphore(self.concurrency)
+        self.users[user_id] += 1
+        try:
+            async with semaphore:
+                yield
+        finally:
+            self.users[user_id] -= 1
+            if not self.users[user_id]:
+                del self.users[user_id]
+                del self.semaphores[user_id]
+
+    def _used(self, user_id: int) -> int:
+        spent = self.spent.get(user_id)
+        if not spent:
+            return 0
+        horizon = time.monotonic() - self.window
+        while spent and spent[0][0] <= horizon:
+            spent.popleft()
+        if not spent:
+            del self.spent[user_id]
+            return 0
+        return sum(tokens for _, tokens in spent)
+
+    def remaining(self, user_id: int) -> int | None:
+        """ Tokens left in the current window, None when there is no budget"""
+        if self.budget <= 0:
+            return None
+        return max(self.budget - self._used(user_id), 0)
+
+    def exhausted(self, user_id: int) -> bool:
+        return self.remaining(user_id) == 0
+
+    def spend(self, user_id: int, tokens: int):
+        if self.budget > 0 and tokens > 0:
+            self.spent[user_id].append((time.monotonic(), tokens))
+
+
+prompt_limiter = PromptLimiter()
@@ -0,0 +1,60 @@
+import logging
+from collections import Counter
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from sqlalchemy import event
+
+from app.db import engine
+from settings import DB_N_PLUS_ONE_THRESHOLD
+
+
+class StatementStats:
+    """ SQL statements executed inside one count_statements() block, grouped by statement text"""
+
+    def __init__(self):
+        self.statements: Counter[str] = Counter()
+
+    @property
+    def total(self) -> int:
+        return sum(self.statements.values())
+
+    def n_plus_one(self, threshold: int = DB_N_PLUS_ONE_THRESHOLD) -> dict[str, int]:
+        """ Statements repeated at least threshold times - usually a lazy load inside a loop"""
+        return {statement: count for statement, count in self.statements.items() if count >= threshold}
+
+
+_current_stats: ContextVar[StatementStats | None] = ContextVar("statement_stats", default=None)
+
+
+@event.listens_for(engine.sync_engine, "before_cursor_execute")
+def _count_statement(conn, cursor, statement, parameters, context, executemany):
+    stats = _current_stats.get()
+    if stats is not None:
+        stats.statements[statement] += 1
+
+
+@contextmanager
+def count_statements():
+    """
+    Count statements executed in the block - for tests and the debug middleware.
+        with count_statements() as stats:
+            ...
+        assert stats.total <= 2
+    """
+    stats = StatementStats()
+    token = _current_stats.set(stats)
+    try:
+        yield stats
+    finally:
+        _current_stats.reset(token)
+
+
+async def statement_counter_middleware(request, call_next):
+    """ Debug middleware - reports statements per request in X-DB-Statements and logs N+1 patterns"""
+    with count_statements() as stats:
+        response = await call_next(request)
+    response.headers["X-DB-Statements"] = str(stats.total)
+    for statement, count in stats.n_plus_one().items():
+        logging.warning(f"Possible N+1: >> {count} x {statement!r} \n {request.method} {request.url.path}")
+    return response
@@ -0,0 +1,187 @@
+import abc
+import bisect
+import logging
+import re
+from collections import defaultdict
+
+from sqlalchemy import select, func, or_
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.db import async_session_maker
+from app.models import Release
+from settings import RELEASE_SEARCH_BACKEND
+
+TOKEN_RE = re.compile(r"\w+")
+# Columns returned by search, rank is added to every row
+RESULT_FIELDS = ("id", "name", "artists", "genre", "record_label", "release_date")
+# Field -> weight, name and artists matter more than the story text
+SEARCH_WEIGHTS = {"name": 1.0, "artists": 1.0, "genre": 0.4, "record_label": 0.4, "story_text": 0.1}
+
+
+def tokenize(text: str | None) -> list[str]:
+    return TOKEN_RE.findall(text.lower()) if text else []
+
+
+class ReleaseSearch(abc.ABC):
+    """
+    Release search backend - relevance ranked, prefix matching and typo tolerant.
+    index() / remove() are called by release write methods, rebuild() on startup.
+    """
+
+    @abc.abstractmethod
+    async def search(self, session: AsyncSession, query: str, limit: int) -> list[dict]:
+        ...
+
+    def index(self, release: Release):
+        pass
+
+    def remove(self, release_id: int):
+        pass
+
+    async def rebuild(self):
+        pass
+
+
+class PostgresReleaseSearch(ReleaseSearch):
+    """
+    Search on Release.search_vector (weighted tsvector, GIN) for ranked prefix matches
+    and pg_trgm indexes on name / artists for typos. Indexes are kept by Postgres itself.
+    """
+
+    async def search(self, session: AsyncSession, query: str, limit: int) -> list[dict]:
+        tokens = tokenize(query)
+        if not tokens:
+            return []
+        ts_query = func.to_tsquery("simple", " & ".join(f"{token}:*" for token in tokens))
+        text = " ".join(tokens)
+        rank = (func.ts_rank(Release.search_vector, ts_query)
+                + func.greatest(func.similarity(Release.name, text), func.similarity(Release.artists, text)))
+        statement = select(*(getattr(Release, field) for field in RESULT_FIELDS), rank.label("rank")) \
+            .where(or_(Release.search_vector.op("@@")(ts_query),
+                       Release.name.op("%")(text),
+                       Release.artists.op("%")(text))) \
+            .order_by(rank.desc()).limit(limit)
+        results = await session.execute(statement)
+        return [dict(row._mapping) for row in results]
+
+
+class InMemoryReleaseSearch(ReleaseSearch):
+    """
+    In-process inverted index - for tests and deployments without Postgres extensions.
+    Exact token hits score full weight, prefix hits less, one or two typos even less.
+    """
+
+    def __init__(self):
+        self._reset()
+
+    def _reset(self):
+        self.documents: dict[int, dict] = {}
+        # release_id -> its tokens, for remove()
+        self.tokens: dict[int, set[str]] = {}
+        # token -> {release_id: weight}
+        self.postings: dict[str, dict[int, float]] = defaultdict(dict)
+        # sorted vocabulary for prefix lookups
+        self.vocabulary: list[str] = []
+        # trigram -> tokens, candidates for typo matching
+        self.trigrams: dict[str, set[str]] = defaultdict(set)
+
+    @staticmethod
+    def _trigrams(token: str) -> set[str]:
+        padded = f"  {token} "
+        return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+    def index(self, release: Release):
+        self.remove(release.id)
+        self.documents[release.id] = {field: getattr(release, field) for field in RESULT_FIELDS}
+        self.tokens[release.id] = set()
+        for field, weight in SEARCH_WEIGHTS.items():
+            for token in tokenize(getattr(release, field)):
+                self.tokens[release.id].add(token)
+                if token not in self.postings:
+                    bisect.insort(self.vocabulary, token)
+                    for trigram in self._trigrams(token):
+                        self.trigrams[trigram].add(token)
+                postings = self.postings[token]
+                postings[release.id] = max(postings.get(release.id, 0.0), weight)
+
+    def remove(self, release_id: int):
+        if self.documents.pop(release_id, None) is None:
+            return
+        for token in self.tokens.pop(release_id):
+            postings = self.postings[token]
+            del postings[release_id]
+            if not postings:
+                del self.postings[token]
+                del self.vocabulary[bisect.bisect_left(self.vocabulary, token)]
+                for trigram in self._trigrams(token):
+                    self.trigrams[trigram].discard(token)
+
+    def _prefixed(self, prefix: str) -> list[str]:
+        start = bisect.bisect_left(self.vocabulary, prefix)
+        end = bisect.bisect_left(self.vocabulary, prefix + "\uffff")
+        return self.vocabulary[start:end]
+
+    def _fuzzy(self, token: str) -> list[str]:
+        if len(token) < 4:
+            return []
+        allowed = 1 if len(token) < 8 else 2
+        candidates = set()
+        for trigram in self._trigrams(token):
+            candidates |= self.trigrams.get(trigram, set())
+        return [candidate for candidate in candidates
+                if abs(len(candidate) - len(token)) <= allowed and distance(token, candidate) <= allowed]
+
+    def _token_scores(self, token: str) -> dict[int, float]:
+        scores: dict[int, float] = defaultdict(float)
+        for match in self._prefixed(token):
+            factor = 1.0 if match == token else 0.7
+            for release_id, weight in self.postings[match].items():
+                scores[release_id] = max(scores[release_id], weight * factor)
+        if not scores:
+            for match in self._fuzzy(token):
+                for release_id, weight in self.postings[match].items():
+                    scores[release_id] = max(scores[release_id], weight * 0.4)
+        return scores
+
+    async def search(self, session: AsyncSession, query: str, limit: int) -> list[dict]:
+        tokens = tokenize(query)
+        if not tokens:
+            return []
+        # Every token has to match, as in the tsquery "a:* & b:*"
+        total = None
+        for token in tokens:
+            scores = self._token_scores(token)
+            if total is None:
+                total = scores
+            else:
+                total = {release_id: total[release_id] + score
+                         for release_id, score in scores.items() if release_id in total}
+            if not total:
+                return []
+        ranked = sorted(total.items(), key=lambda item: item[1], reverse=True)[:limit]
+        return [dict(self.documents[release_id], rank=score) for release_id, score in ranked]
+
+    async def rebuild(self):
+        self._reset()
+        try:
+            async with async_session_maker() as session:
+                results = await session.stream_scalars(select(Release).execution_options(yield_per=1000))
+                async for release in results:
+                    self.index(release)
+        except SQLAlchemyError as e:
+            logging.error(f"SQLAlchemyError: >> {e} \n {self.rebuild.__name__}")
+
+
+def distance(first: str, second: str) -> int:
+    """ Levenshtein distance"""
+    previous = list(range(len(second) + 1))
+    for i, first_char in enumerate(first, 1):
+        current = [i]
+        for j, second_char in enumerate(second, 1):
+            current.append(min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (first_char != second_char)))
+        previous = current
+    return previous[-1]
+
+
+release_search = PostgresReleaseSearch() if RELEASE_SEARCH_BACKEND == "postgres" else InMemoryReleaseSearch()
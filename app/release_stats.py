@@ -0,0 +1,81 @@
+"""
+Release counters by genre, record label and month of release_date.
+Rebuild from scratch:  python -m app.release_stats rebuild
+"""
+import asyncio
+import sys
+
+from sqlalchemy import select, delete, func, literal, insert as sql_insert
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.db import async_session_maker
+from app.models import Release, ReleaseStat
+
+UNKNOWN = "unknown"
+
+
+def known_or_unknown(column):
+    """ NULL and "" both go to UNKNOWN - the rule of release_buckets()"""
+    return func.coalesce(func.nullif(column, ""), UNKNOWN)
+
+
+# dimension -> SQL bucket expression; month is "YYYY-MM" out of the text release_date
+DIMENSIONS = {
+    "genre": known_or_unknown(Release.genre),
+    "record_label": known_or_unknown(Release.record_label),
+    "month": known_or_unknown(func.substr(Release.release_date, 1, 7)),
+}
+
+
+def release_buckets(release: Release) -> dict[str, str]:
+    """ Same buckets as DIMENSIONS, computed for one release in Python"""
+    return {
+        "genre": release.genre or UNKNOWN,
+        "record_label": release.record_label or UNKNOWN,
+        "month": str(release.release_date)[:7] if release.release_date else UNKNOWN,
+    }
+
+
+async def change_stats(session: AsyncSession, release: Release, delta: int):
+    """ Move every counter of the release by delta, in the caller transaction"""
+    rows = [{"dimension": dimension, "bucket": bucket, "count": delta}
+            for dimension, bucket in release_buckets(release).items()]
+    statement = insert(ReleaseStat).values(rows)
+    statement = statement.on_conflict_do_update(
+        index_elements=[ReleaseStat.dimension, ReleaseStat.bucket],
+        set_={"count": ReleaseStat.count + statement.excluded.count})
+    await session.execute(statement)
+
+
+async def read_stats(session: AsyncSession, dimension: str | None = None) -> dict[str, dict[str, int]]:
+    """
+    Counters grouped by dimension - reads O(number of buckets) rows.
+    :param dimension: one of DIMENSIONS, all of them when None
+    """
+    statement = select(ReleaseStat).where(ReleaseStat.count > 0)
+    if dimension:
+        statement = statement.where(ReleaseStat.dimension == dimension)
+    results = await session.execute(statement.order_by(ReleaseStat.dimension, ReleaseStat.bucket))
+    stats = {name: {} for name in DIMENSIONS if dimension in (None, name)}
+    for stat in results.scalars():
+        stats.setdefault(stat.dimension, {})[stat.bucket] = stat.count
+    return stats
+
+
+async def rebuild():
+    """ Recompute every counter from release_table in one transaction"""
+    async with async_session_maker() as session:
+        await session.execute(delete(ReleaseStat))
+        for dimension, bucket in DIMENSIONS.items():
+            await session.execute(sql_insert(ReleaseStat).from_select(
+                ["dimension", "bucket", "count"],
+                select(literal(dimension), bucket, func.count()).select_from(Release).group_by(bucket)))
+        await session.commit()
+
+
+if __name__ == "__main__":
+    if sys.argv[1:] != ["rebuild"]:
+        sys.exit("usage: python -m app.release_stats rebuild")
+    asyncio.run(rebuild())
+    print("Release stats rebuilt")
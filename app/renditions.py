@@ -0,0 +1,56 @@
+import asyncio
+import logging
+import os
+
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.exc import SQLAlchemyError
+
+from app.db import async_session_maker
+from app.image_cache import FORMATS, make_rendition, run_in_pool
+from app.models import PictureRendition
+from settings import PICTURE_RENDITIONS, PICTURE_RENDITION_FORMAT, PICTURE_RENDITION_DIR
+
+
+def rendition_path(picture_id: int, name: str) -> str:
+    return os.path.join(PICTURE_RENDITION_DIR, f"{picture_id}_{name}.{FORMATS[PICTURE_RENDITION_FORMAT][0]}")
+
+
+async def build_renditions(picture_id: int, source: str):
+    """
+    Post-upload stage - make every configured rendition of the picture in the process pool
+    and record them against the picture. Runs as a background task after the response is sent.
+    :param picture_id:
+    :param source: original picture file
+    """
+    os.makedirs(PICTURE_RENDITION_DIR, exist_ok=True)
+    names = list(PICTURE_RENDITIONS)
+    results = await asyncio.gather(
+        *(run_in_pool(make_rendition, source, rendition_path(picture_id, name),
+                      PICTURE_RENDITIONS[name], PICTURE_RENDITION_FORMAT) for name in names),
+        return_exceptions=True)
+    rows = []
+    for name, result in zip(names, results):
+        if isinstance(result, BaseException):
+            logging.error(f"Rendition failed: >> {result} \n picture={picture_id} {name}")
+            continue
+        width, height, size = result
+        rows.append({"picture_id": picture_id,
+                     "name": name,
+                     "filename": rendition_path(picture_id, name),
+                     "media_type": FORMATS[PICTURE_RENDITION_FORMAT][1],
+                     "width": width,
+                     "height": height,
+                     "size": size})
+    if not rows:
+        return
+    try:
+        async with async_session_maker() as session:
+            statement = insert(PictureRendition).values(rows)
+            statement = statement.on_conflict_do_update(
+                constraint="uq_rendition_picture_name",
+                set_={column: statement.excluded[column]
+                      for column in ("filename", "media_type", "width", "height", "size")})
+            await session.execute(statement)
+            await session.commit()
+    except SQLAlchemyError as e:
+        logging.error(f"SQLAlchemyError: >> {e} \n {build_renditions.__name__}")
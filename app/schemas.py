@@ -1,10 +1,11 @@
-from pydantic import Field, BaseModel
+from pydantic import Field, BaseModel, root_validator, validator
 from pydantic.types import constr
 from fastapi_users import schemas
+from enum import Enum
 from typing import Optional
 from datetime import datetime
 from pydantic import BaseModel, EmailStr
-from datetime import date, datetime, time, timedelta
+from datetime import date, datetime, time, timedelta, timezone
 
 # USER schemas
 
@@ -88,6 +89,23 @@ class ReactionResponse(BaseModel):
         orm_mode = True
 
 
+class ReactionImport(BaseModel):
+    """ One NDJSON line of a reaction import"""
+    user_id: int
+    message_id: int
+    type: str
+
+
+class ReactionSummary(BaseModel):
+    message_id: int
+    counts: dict[str, int]
+    mine: Optional[str] = None
+
+
+class ReactionSummaryResponse(BaseModel):
+    summaries: list[ReactionSummary]
+
+
 # Response schema
 #    ================================================================= Message
 class MessageCreate(BaseModel):
@@ -101,12 +119,85 @@ class MessageCreate(BaseModel):
         orm_mode = True
 
 
+class MessageImport(BaseModel):
+    """
+    One NDJSON line of a message import - created_at is kept, now when missing.
+    source_id - id in the system the history comes from, a line imported twice is skipped as a duplicate.
+    """
+    author_id: Optional[int]
+    body: str
+    created_at: Optional[datetime]
+    chat_id: int
+    source_id: Optional[constr(min_length=1, max_length=255)]
+
+    @validator("created_at")
+    def naive_utc(cls, value):
+        # Exports carry offsets ("...Z"), the column is timestamp without time zone
+        if value is not None and value.tzinfo is not None:
+            value = value.astimezone(timezone.utc).replace(tzinfo=None)
+        return value
+
+    @root_validator(skip_on_failure=True)
+    def source_id_needs_created_at(cls, values):
+        # Duplicates are found by (source_id, created_at) - the partition key is a part of every unique index
+        if values.get("source_id") is not None and values.get("created_at") is None:
+            raise ValueError("created_at is required with source_id")
+        return values
+
+
+class ReactionLoading(str, Enum):
+    """ How message lists load reactions: not at all, full rows (selectin) or counters only"""
+    none = "none"
+    selectin = "selectin"
+    counts = "counts"
+
+
+class MessageRead(MessageCreate):
+    reactions: Optional[list[ReactionInner]]
+    reaction_counts: Optional[dict[str, int]]
+
+
 class MessageResponse(BaseModel):
-    messages: list[MessageCreate]
+    messages: list[MessageRead]
+    next: Optional[str] = None
 
     class Config:
         orm_mode = True
 
 
+#    ================================================================= Chat
+class ChatRead(BaseModel):
+    chat_id: int
+    message_count: int
+    unread: int
+    last_read_id: int
+    last_message: Optional[MessageCreate]
+
+
+class ChatListResponse(BaseModel):
+    chats: list[ChatRead]
+    next: Optional[str] = None
+
+
 class GPT_Engines(BaseModel):
-    engines: list
\ No newline at end of file
+    engines: list
+
+
+class PromptBatch(BaseModel):
+    prompts: list[str] = Field(..., min_items=1)
+
+
+class ImageJobRead(BaseModel):
+    id: int
+    status: str
+    prompt: str
+    size: str
+    n: int
+    tag: Optional[str]
+    error: Optional[str]
+    picture_ids: Optional[list[int]]
+    created_at: Optional[datetime]
+    finished_at: Optional[datetime]
+
+    class Config:
+        orm_mode = True
\ No newline at end of file
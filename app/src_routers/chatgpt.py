@@ -1,14 +1,26 @@
-import openai
-from fastapi import APIRouter, Depends, HTTPException
+import asyncio
+import json
+import logging
+
+import aiohttp
+
+from fastapi import APIRouter, BackgroundTasks, Depends, HTTPException, Query
+from sqlalchemy import select
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.ext.asyncio import AsyncSession
 from starlette import status
-from starlette.responses import FileResponse, StreamingResponse
+from starlette.responses import StreamingResponse
 
-from app.models import User
-from app.schemas import GPT_Engines
+from app.db import get_async_session
+from app.image_jobs import run_image_job
+from app.models import User, ImageJob
+from app.openai_client import openai_client, OpenAIError
+from app.prompt_cache import prompt_cache, prompt_key, model_list
+from app.prompt_limits import prompt_limiter, estimate_tokens
+from app.schemas import GPT_Engines, PromptBatch, ImageJobRead
 from app.users import fastapi_users
-from settings import OPEN_AI_API_KEY, OPEN_AI_ENGINE
+from settings import OPEN_AI_ENGINE, PROMPT_BATCH_MAX
 
-openai.api_key = OPEN_AI_API_KEY
 tried_models = ["code-cushman-001", ]
 
 router = APIRouter(
@@ -18,58 +30,176 @@ router = APIRouter(
 current_user = fastapi_users.current_user(active=True)
 
 
-def show_list_models():
-    models = openai.Model.list()
-    return models.data
+async def show_list_models():
+    return await model_list.get()
+
 
+async def send_prompt(gpt_prompt: str, user_id: int):
+    """
+    Completion through the prompt cache - identical prompts share one upstream call.
+    Runs in one of the user's prompt slots, the upstream call spends the user's token budget.
+    """
+    key = prompt_key(gpt_prompt, OPEN_AI_ENGINE, {})
 
-def send_prompt(gpt_prompt: str):
-    raw_response = openai.Completion.create(
-        engine=OPEN_AI_ENGINE,
-        prompt=gpt_prompt,
-    )
-    proper_response = raw_response['choices'][0]['text']
-    return proper_response
+    async def call():
+        result = await openai_client.completion(gpt_prompt, engine=OPEN_AI_ENGINE)
+        text = result["choices"][0]["text"]
+        usage = result.get("usage") or {}
+        prompt_limiter.spend(user_id, usage.get("total_tokens") or estimate_tokens(gpt_prompt + text))
+        return text
+
+    try:
+        async with prompt_limiter.slot(user_id):
+            if prompt_limiter.exhausted(user_id):
+                raise HTTPException(status_code=status.HTTP_429_TOO_MANY_REQUESTS, detail="Token budget exceeded")
+            return await prompt_cache.get_or_call(key, call)
+    except OpenAIError as e:
+        raise HTTPException(status_code=status.HTTP_502_BAD_GATEWAY, detail=e.message)
+    except asyncio.TimeoutError:
+        raise HTTPException(status_code=status.HTTP_504_GATEWAY_TIMEOUT, detail="OpenAI timeout")
+
+
+async def stream_prompt(gpt_prompt: str, user_id: int):
+    """ Server-sent events: one "data:" event per completion piece, then "data: [DONE]" """
+    async with prompt_limiter.slot(user_id):
+        if prompt_limiter.exhausted(user_id):
+            yield f"event: error\ndata: {json.dumps({'detail': 'Token budget exceeded'})}\n\n"
+            return
+        answer = []
+        try:
+            async for text in openai_client.stream(gpt_prompt, engine=OPEN_AI_ENGINE):
+                answer.append(text)
+                yield f"data: {json.dumps({'text': text})}\n\n"
+        except OpenAIError as e:
+            yield f"event: error\ndata: {json.dumps({'detail': e.message})}\n\n"
+        except asyncio.TimeoutError:
+            yield f"event: error\ndata: {json.dumps({'detail': 'OpenAI timeout'})}\n\n"
+        finally:
+            # Streamed completions report no usage
+            prompt_limiter.spend(user_id, estimate_tokens(gpt_prompt + "".join(answer)))
+        yield "data: [DONE]\n\n"
+
+
+async def run_batch(prompts: list[str], user_id: int):
+    """
+    NDJSON line per prompt, in input order - a line goes out as soon as its prompt and every prompt
+    before it are done. Concurrency is bounded by the user's prompt slots.
+    """
+    async def run(gpt_prompt: str) -> dict:
+        # Every failure is an item of its own - one prompt must not break the stream of the others
+        try:
+            return {"answer": await send_prompt(gpt_prompt, user_id)}
+        except HTTPException as e:
+            return {"error": e.detail, "status": e.status_code}
+        except (OpenAIError, aiohttp.ClientError) as e:
+            return {"error": str(e), "status": status.HTTP_502_BAD_GATEWAY}
+        except asyncio.TimeoutError:
+            return {"error": "OpenAI timeout", "status": status.HTTP_504_GATEWAY_TIMEOUT}
+        except Exception as e:
+            logging.error(f"Batch prompt failed: >> {e!r} \n {run_batch.__name__}")
+            return {"error": "Internal error", "status": status.HTTP_500_INTERNAL_SERVER_ERROR}
+
+    tasks = [asyncio.create_task(run(gpt_prompt)) for gpt_prompt in prompts]
+    try:
+        for index, task in enumerate(tasks):
+            yield json.dumps({"index": index, **await task}) + "\n"
+    finally:
+        # Client went away - drop the prompts not sent yet
+        for task in tasks:
+            task.cancel()
 
 
 @router.post("/do",
              status_code=status.HTTP_200_OK)
-async def make_prompt(prompt: str,
+async def make_prompt(prompt: str, stream: bool = False,
                       user: User = Depends(current_user)):
     """
     Method to make prompt to the OpenAI ChatGPT.
     :param prompt:
+    :param stream: send the answer as server-sent events while it is generated
     :param user:
     :return: answer
     """
     if user.is_active:
-        result = send_prompt(prompt)
+        if stream:
+            return StreamingResponse(stream_prompt(prompt, user.id), media_type="text/event-stream")
+        result = await send_prompt(prompt, user.id)
         return {"answer": result}
     else:
         raise HTTPException(status_code=400, detail="Inactive user")
 
 
-@router.post("/image",
+@router.post("/batch",
              status_code=status.HTTP_200_OK)
-async def make_image(prompt: str | None, image_size: str,
-                     user: User = Depends(current_user)):
+async def make_prompt_batch(batch: PromptBatch,
+                            user: User = Depends(current_user)):
     """
-    Method to send OpenAI Prompt to Image generation (DALL·E) .
-    :param image_size: default_value "512x512"
+    Method to run a list of prompts in one request.
+    :param batch: prompts, at most PROMPT_BATCH_MAX
+    :param user:
+    :return: application/x-ndjson stream - {"index", "answer"} or {"index", "error", "status"} per prompt
+    """
+    if not user.is_active:
+        raise HTTPException(status_code=400, detail="Inactive user")
+    if len(batch.prompts) > PROMPT_BATCH_MAX:
+        raise HTTPException(status_code=400, detail=f"At most {PROMPT_BATCH_MAX} prompts in a batch")
+    return StreamingResponse(run_batch(batch.prompts, user.id), media_type="application/x-ndjson")
+
+
+@router.post("/image",
+             response_model=ImageJobRead,
+             status_code=status.HTTP_202_ACCEPTED)
+async def make_image(prompt: str, background_tasks: BackgroundTasks,
+                     image_size: str = Query(default="512x512", regex="^(256x256|512x512|1024x1024)$"),
+                     n: int = Query(default=4, ge=1, le=10),
+                     tag: str = "dalle",
+                     user: User = Depends(current_user),
+                     session: AsyncSession = Depends(get_async_session)):
+    """
+    Method to send OpenAI Prompt to Image generation (DALL·E) - the images are made in the background.
     :param prompt:
+    :param image_size: default_value "512x512"
+    :param n: number of images
+    :param tag: tag of the stored pictures
     :param user:
-    :return: StreamResponse
+    :param session:
+    :return: job - poll /prompt/image/{job_id} until it is done, then read its pictures from /pictures/get
     """
-    if user.is_active:
-        if not image_size:
-            image_size = "512x512"
-            image_resp = openai.Image.create(prompt=prompt, n=4, size=image_size)
-            return FileResponse(image_resp)
-        else:
-            image_resp = openai.Image.create(prompt=prompt, n=4, size=image_size)
-            return StreamingResponse(image_resp)
-    else:
+    if not user.is_active:
         raise HTTPException(status_code=400, detail="Error")
+    try:
+        job = ImageJob(user_id=user.id, prompt=prompt, size=image_size, n=n, tag=tag, status="pending")
+        session.add(job)
+        await session.commit()
+    except SQLAlchemyError as e:
+        logging.error(f"SQLAlchemyError: >> {e} \n {make_image.__name__}")
+        raise HTTPException(status_code=400, detail=str(e))
+    background_tasks.add_task(run_image_job, job.id)
+    return job
+
+
+@router.get("/image/{job_id}",
+            response_model=ImageJobRead,
+            status_code=status.HTTP_200_OK)
+async def get_image_job(job_id: int,
+                        user: User = Depends(current_user),
+                        session: AsyncSession = Depends(get_async_session)):
+    """
+    Method to poll an image generation job.
+    :param job_id:
+    :param user:
+    :param session:
+    :return: job with its status and, once done, the ids of the stored pictures
+    """
+    try:
+        statement = select(ImageJob).where(ImageJob.id == job_id).where(ImageJob.user_id == user.id)
+        job = (await session.execute(statement)).scalars().first()
+    except SQLAlchemyError as e:
+        logging.error(f"SQLAlchemyError: >> {e} \n {get_image_job.__name__}")
+        raise HTTPException(status_code=400, detail=str(e))
+    if job is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Not found")
+    return job
 
 
 @router.get("/engines",
@@ -79,7 +209,7 @@ async def list_engines(user: User = Depends(current_user)):
     """ List all actual Open AI engines"""
     if user.is_active:
         try:
-            result = show_list_models()
+            result = await show_list_models()
             return {"engines": result}
         except BaseException as e:
             raise HTTPException(status_code=400, detail=str(e))
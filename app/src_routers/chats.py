@@ -0,0 +1,85 @@
+from fastapi import APIRouter, Depends, HTTPException, Query
+from sqlalchemy import select
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.ext.asyncio import AsyncSession
+from starlette import status
+
+from app.chat_summary import mark_read, unread_count
+from app.db import get_async_session
+from app.models import User, ChatSummary, ChatMember
+from app.pagination import encode_cursor, decode_cursor
+from app.schemas import ChatListResponse, ChatRead
+from app.users import fastapi_users
+from settings import CHAT_PAGE_SIZE, CHAT_PAGE_SIZE_MAX
+
+current_user = fastapi_users.current_user(active=True)
+
+router = APIRouter(
+    responses={404: {"description": "Not found"}},
+)
+
+
+def chat_item(member: ChatMember, summary: ChatSummary) -> dict:
+    return {"chat_id": member.chat_id,
+            "message_count": summary.message_count,
+            "unread": unread_count(member, summary),
+            "last_read_id": member.last_read_id,
+            "last_message": {"id": summary.last_message_id,
+                             "author_id": summary.last_author_id,
+                             "body": summary.last_body,
+                             "created_at": summary.last_created_at,
+                             "chat_id": summary.chat_id}}
+
+
+@router.get("/",
+            response_model=ChatListResponse,
+            status_code=status.HTTP_200_OK)
+async def get_chats(user: User = Depends(current_user),
+                    session: AsyncSession = Depends(get_async_session),
+                    limit: int = Query(default=CHAT_PAGE_SIZE, ge=1, le=CHAT_PAGE_SIZE_MAX),
+                    cursor: str | None = None):
+    """
+    Method to get the user's chats - most recent activity first, page by page.
+    Reads summary state only, message_table is not touched.
+    :param limit: page size
+    :param cursor: "next" value from the previous page
+    :return: chats with last message, message count and unread count, cursor of the next page
+    """
+    try:
+        statement = select(ChatMember, ChatSummary) \
+            .join(ChatSummary, ChatSummary.chat_id == ChatMember.chat_id) \
+            .where(ChatMember.user_id == user.id)
+        if cursor:
+            statement = statement.where(ChatSummary.last_message_id < decode_cursor(cursor))
+        statement = statement.order_by(ChatSummary.last_message_id.desc()).limit(limit + 1)
+        rows = (await session.execute(statement)).all()
+    except SQLAlchemyError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    page = rows[:limit]
+    next_cursor = None
+    if len(rows) > limit:
+        next_cursor = encode_cursor(page[-1].ChatSummary.last_message_id)
+    return {"chats": [chat_item(row.ChatMember, row.ChatSummary) for row in page], "next": next_cursor}
+
+
+@router.post("/{chat_id}/read",
+             response_model=ChatRead,
+             status_code=status.HTTP_200_OK)
+async def read_chat(chat_id: int, up_to: int,
+                    user: User = Depends(current_user),
+                    session: AsyncSession = Depends(get_async_session)):
+    """
+    Method to mark the chat read up to a message id - joins the chat on the first call.
+    :param chat_id:
+    :param up_to: last read message id
+    :return: chat with the new unread count
+    """
+    try:
+        member = await mark_read(session, chat_id, user.id, up_to)
+        if member is None:
+            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Chat not found")
+        await session.commit()
+        summary = await session.get(ChatSummary, chat_id)
+    except SQLAlchemyError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return chat_item(member, summary)
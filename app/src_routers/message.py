@@ -1,17 +1,26 @@
-from fastapi import APIRouter, Depends, HTTPException
+from fastapi import APIRouter, Depends, HTTPException, Query, Request
 from sqlalchemy import select
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.orm import selectinload
 from sqlalchemy.exc import SQLAlchemyError
 from sqlalchemy.ext.asyncio import AsyncSession
 from starlette import status
 from datetime import datetime
-from app.models import User,Message
+from app.models import User,Message, ReactionCount
 from app.db import get_async_session
-from app.schemas import MessageResponse, MessageCreate
+from app.schemas import MessageResponse, MessageCreate, ReactionInner, ReactionLoading, MessageImport
 from app.users import fastapi_users
 from fastapi_cache.decorator import cache
-from settings import REDIS_CACHING_HOUR
+from app.pagination import encode_cursor, decode_cursor, paginate
+from app.message_archive import archive_reader
+from app.message_partitions import message_partitions
+from app.chat_summary import record_messages, INSERTED_COLUMNS
+from app.cache import tagged_key_builder, invalidate, invalidate_namespace, chat_tag, author_tag, MESSAGES_NAMESPACE
+from app.bulk_import import import_ndjson, Rows
+from settings import REDIS_CACHING_HOUR, MESSAGE_PAGE_SIZE, MESSAGE_PAGE_SIZE_MAX
 
 current_user = fastapi_users.current_user(active=True)
+current_superuser = fastapi_users.current_user(active=True, superuser=True)
 
 
 
@@ -19,6 +28,63 @@ router = APIRouter(
     responses={404: {"description": "Not found"}},
 )
 
+
+async def load_page(session: AsyncSession, statement, limit: int, reactions: ReactionLoading):
+    """
+    Run a keyset page query and shape the rows with the requested reaction loading.
+    :param statement: select(Message) with filters, cursor and order applied
+    :param limit: page size
+    :param reactions: none - no reactions, selectin - full rows in one extra query, counts - counters only
+    :return: message dicts and cursor of the next page
+    """
+    if reactions == ReactionLoading.selectin:
+        statement = statement.options(selectinload(Message.reactions))
+    results = await session.execute(statement.limit(limit + 1))
+    instances, next_cursor = paginate(results.scalars().all(), limit)
+    counts = {}
+    if reactions == ReactionLoading.counts and instances:
+        counters = await session.execute(
+            select(ReactionCount).where(ReactionCount.message_id.in_([m.id for m in instances]))
+            .where(ReactionCount.count > 0))
+        for counter in counters.scalars():
+            counts.setdefault(counter.message_id, {})[counter.type] = counter.count
+    messages = []
+    for instance in instances:
+        item = MessageCreate.from_orm(instance).dict()
+        if reactions == ReactionLoading.selectin:
+            item["reactions"] = [ReactionInner.from_orm(reaction).dict() for reaction in instance.reactions]
+        elif reactions == ReactionLoading.counts:
+            item["reaction_counts"] = counts.get(instance.id, {})
+        messages.append(item)
+    return messages, next_cursor
+
+
+async def merge_archived(session: AsyncSession, messages: list[dict], next_cursor: str | None, limit: int,
+                         reactions: ReactionLoading, before: int | None, chat_id: int | None = None,
+                         author_id: int | None = None, since: datetime | None = None):
+    """
+    Complete a hot page with archived messages - keyset order by id holds across both.
+    While the hot table has more rows only archives with ids above the page bottom are opened.
+    :return: message dicts and cursor of the next page
+    """
+    floor = messages[-1]["id"] if next_cursor is not None else None
+    archived = await archive_reader.newest(session, limit + 1, before=before, floor=floor,
+                                           chat_id=chat_id, author_id=author_id, since=since)
+    if not archived:
+        return messages, next_cursor
+    for row in archived:
+        item = {field: row[field] for field in ("id", "author_id", "body", "created_at", "chat_id")}
+        if reactions == ReactionLoading.selectin:
+            item["reactions"] = row["reactions"]
+        elif reactions == ReactionLoading.counts:
+            item["reaction_counts"] = row["reaction_counts"]
+        messages.append(item)
+    messages.sort(key=lambda item: item["id"], reverse=True)
+    more = next_cursor is not None or len(messages) > limit
+    messages = messages[:limit]
+    return messages, encode_cursor(messages[-1]["id"]) if more else None
+
+
 @router.post("/add",
              response_model=MessageResponse,response_model_exclude_unset=True,
              status_code=status.HTTP_201_CREATED)
@@ -28,47 +94,134 @@ async def add_message(user: User = Depends(current_user),
     try:
         new_message = Message(author_id=user.id,
                               body=message.body,
-                              created_at=str(datetime.now()),
+                              created_at=datetime.now(),
                               chat_id=message.chat_id
                               )
         session.add(new_message)
+        await session.flush()
+        await record_messages(session, [new_message])
         await session.commit()
     except SQLAlchemyError as e:
         raise HTTPException(status_code=400, detail=str(e))
+    await invalidate(MESSAGES_NAMESPACE, chat_tag(new_message.chat_id), author_tag(user.id))
 
-    return {"messages": [new_message]}
+    return {"messages": [MessageCreate.from_orm(new_message).dict()]}
 
 
 @router.get("/get",
-            response_model=MessageResponse,
+            response_model=MessageResponse,response_model_exclude_unset=True,
             status_code=status.HTTP_200_OK)
-@cache(expire=REDIS_CACHING_HOUR,namespace='messages_cache_hour')
+@cache(expire=REDIS_CACHING_HOUR,namespace=MESSAGES_NAMESPACE,
+       key_builder=tagged_key_builder(lambda kwargs: author_tag(kwargs["user"].id)))
 async def get_current_user_messages(user: User = Depends(current_user),
-                       session: AsyncSession = Depends(get_async_session)):
+                       session: AsyncSession = Depends(get_async_session),
+                       limit: int = Query(default=MESSAGE_PAGE_SIZE, ge=1, le=MESSAGE_PAGE_SIZE_MAX),
+                       cursor: str | None = None,
+                       reactions: ReactionLoading = ReactionLoading.none):
+    """
+    Method to get current user messages - newest first, page by page.
+    :param limit: page size
+    :param cursor: "next" value from the previous page
+    :param reactions: none, selectin (full reaction rows) or counts
+    :return: messages and cursor of the next page
+    """
     try:
+        before = decode_cursor(cursor) if cursor else None
         statement = select(Message).where(Message.author_id == user.id)
-        results = await session.execute(statement)
-        instances = results.scalars().all()
-        return {"messages": instances}
+        if before is not None:
+            statement = statement.where(Message.id < before)
+        statement = statement.order_by(Message.id.desc())
+        messages, next_cursor = await load_page(session, statement, limit, reactions)
+        messages, next_cursor = await merge_archived(session, messages, next_cursor, limit, reactions, before,
+                                                     author_id=user.id)
+        return {"messages": messages, "next": next_cursor}
 
     except SQLAlchemyError as e:
         raise HTTPException(status_code=400, detail=str(e))
 
 
 @router.get("/get/{chat_id}",
-            response_model=MessageResponse,
+            response_model=MessageResponse,response_model_exclude_unset=True,
             status_code=status.HTTP_200_OK)
-@cache(expire=REDIS_CACHING_HOUR,namespace='messages_cache_hour')
+@cache(expire=REDIS_CACHING_HOUR,namespace=MESSAGES_NAMESPACE,
+       key_builder=tagged_key_builder(lambda kwargs: chat_tag(kwargs["chat_id"])))
 async def get_messages_by_chat_id(chat_id: int,user: User = Depends(current_user),
-                       session: AsyncSession = Depends(get_async_session)):
+                       session: AsyncSession = Depends(get_async_session),
+                       limit: int = Query(default=MESSAGE_PAGE_SIZE, ge=1, le=MESSAGE_PAGE_SIZE_MAX),
+                       cursor: str | None = None,
+                       since: datetime | None = None,
+                       reactions: ReactionLoading = ReactionLoading.none):
+    """
+    Method to get chat messages - newest first, page by page.
+    :param chat_id:
+    :param limit: page size
+    :param cursor: "next" value from the previous page
+    :param reactions: none, selectin (full reaction rows) or counts
+    :param since: only messages created at or after this time
+    :return: messages and cursor of the next page
+    """
     if user:
         try:
+            before = decode_cursor(cursor) if cursor else None
             statement = select(Message).where(Message.chat_id == chat_id)
-            results = await session.execute(statement)
-            instances = results.scalars().all()
-            return {"messages": instances}
+            if since:
+                statement = statement.where(Message.created_at >= since)
+            if before is not None:
+                statement = statement.where(Message.id < before)
+            statement = statement.order_by(Message.id.desc())
+            messages, next_cursor = await load_page(session, statement, limit, reactions)
+            messages, next_cursor = await merge_archived(session, messages, next_cursor, limit, reactions, before,
+                                                         chat_id=chat_id, since=since)
+            return {"messages": messages, "next": next_cursor}
 
         except SQLAlchemyError as e:
             raise HTTPException(status_code=400, detail=str(e))
 
 
+async def write_messages(session: AsyncSession, rows: Rows) -> tuple[int, int, list[dict]]:
+    """
+    Import chunk writer - one multi-row insert in created_at order, rows of unknown authors are rejected up front.
+    Lines with a source_id already stored are skipped (ON CONFLICT DO NOTHING) and counted as duplicates.
+    """
+    authors = {row.author_id for _, row in rows if row.author_id is not None}
+    known = set()
+    if authors:
+        known = set((await session.execute(select(User.id).where(User.id.in_(authors)))).scalars())
+    errors = [{"line": line, "error": f"Unknown author_id {row.author_id}"}
+              for line, row in rows if row.author_id is not None and row.author_id not in known]
+    now = datetime.now()
+    values = [{"author_id": row.author_id,
+               "body": row.body,
+               "created_at": row.created_at or now,
+               "chat_id": row.chat_id,
+               "source_id": row.source_id}
+              for _, row in rows if row.author_id is None or row.author_id in known]
+    if not values:
+        return 0, 0, errors
+    # Ids follow created_at within the chunk, so keyset pages by id keep the history order
+    values.sort(key=lambda value: value["created_at"])
+    # Imported history may fall into months without a partition yet
+    await message_partitions.ensure([value["created_at"] for value in values])
+    statement = insert(Message).values(values).on_conflict_do_nothing().returning(*INSERTED_COLUMNS)
+    inserted = (await session.execute(statement)).all()
+    await record_messages(session, inserted)
+    return len(inserted), len(values) - len(inserted), errors
+
+
+@router.post("/import",
+             status_code=status.HTTP_200_OK)
+async def import_messages(request: Request, user: User = Depends(current_superuser)):
+    """
+    Method to bulk import chat history - NDJSON body, one message per line:
+    {"author_id": 1, "body": "...", "created_at": "2023-01-01T10:00:00", "chat_id": 5, "source_id": "a-1"}
+    Rows are validated and written chunk by chunk, each chunk in its own transaction.
+    Import history before the chat takes live traffic: ids come from one sequence and pages go by id,
+    so messages imported later sort above newer live ones.
+    :param request:
+    :param user: superuser only
+    :return: inserted total and a report per chunk
+    """
+    report = await import_ndjson(request, MessageImport, write_messages)
+    if report["inserted"]:
+        await invalidate_namespace(MESSAGES_NAMESPACE)
+    return report
@@ -1,18 +1,20 @@
 import logging
-from fastapi import APIRouter, Depends, HTTPException, UploadFile, File
+import os
+from fastapi import APIRouter, BackgroundTasks, Depends, HTTPException, Request, UploadFile, File, Query
 from sqlalchemy import select
 from sqlalchemy.exc import SQLAlchemyError
 from sqlalchemy.ext.asyncio import AsyncSession
 from starlette import status
 
-from PIL import Image
-
-from starlette.responses import FileResponse
-import shutil
-from app.models import User, Picture
+from starlette.concurrency import run_in_threadpool
+from app.models import User, Picture, PictureRendition
 from app.users import fastapi_users
 from app.db import get_async_session
-from settings import root_dir
+from app.image_cache import derivative_cache, FORMATS
+from app.renditions import build_renditions
+from app.file_response import conditional_file_response
+from app.picture_store import save_chunks, guess_media_type, remove_file, PictureTooLarge
+from settings import root_dir, PICTURE_CHUNK_SIZE, PICTURE_RESIZE_MAX_SIDE, PICTURE_RENDITIONS
 
 # Logger configuration
 logging.basicConfig(filename=f'{root_dir}/logs/picture_logger.log', encoding='utf-8', level=logging.INFO)
@@ -25,44 +27,80 @@ router = APIRouter(
 )
 
 
+async def upload_chunks(upload: UploadFile):
+    while chunk := await upload.read(PICTURE_CHUNK_SIZE):
+        yield chunk
+
+
+async def save_upload(upload: UploadFile, directory: str) -> tuple[str, int, str, str]:
+    """
+    Stream upload to disk chunk by chunk, under a unique name.
+    :param upload:
+    :param directory: destination directory
+    :return: path, size in bytes, sha256 hex digest and media type
+    :raises HTTPException: 400 for an empty file name, 413 when the upload is larger than PICTURE_MAX_SIZE
+    """
+    original = os.path.basename(upload.filename or "")
+    if original in ("", ".", ".."):
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Picture file name is missing")
+    try:
+        return await save_chunks(upload_chunks(upload), directory, original)
+    except PictureTooLarge as e:
+        raise HTTPException(status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE, detail=str(e))
+
+
 @router.post("/add",
              status_code=status.HTTP_201_CREATED)
-async def add_picture(tag: str, picture: UploadFile = File(),
+async def add_picture(tag: str, background_tasks: BackgroundTasks, picture: UploadFile = File(),
                       user: User = Depends(current_user),
                       session: AsyncSession = Depends(get_async_session)):
     """ Add file and image response"""
-
-    with open(f"./static/pics/{picture.filename}", "wb+") as buff:
-        shutil.copyfileobj(picture.file, buff)
-        try:
-            new = Picture(user_id=user.id,
-                          filename=str(buff.name),
-                          tag=tag)
-            session.add(new)
-            await session.commit()
-        except SQLAlchemyError as e:
-            logging.error(f"SQLAlchemyError: >> {e} \n {add_picture.__name__}")
-            raise HTTPException(status_code=400, detail=str(e))
-        logging.info(f"Added picture by {user.email} >> {picture.filename}")
-        return {"details": f"{status.HTTP_201_CREATED, buff.name} Successfully added"}
+    filename, size, content_hash, media_type = await save_upload(picture, "./static/pics")
+    try:
+        new = Picture(user_id=user.id,
+                      filename=filename,
+                      tag=tag,
+                      content_hash=content_hash,
+                      size=size,
+                      media_type=media_type)
+        session.add(new)
+        await session.commit()
+    except SQLAlchemyError as e:
+        logging.error(f"SQLAlchemyError: >> {e} \n {add_picture.__name__}")
+        await run_in_threadpool(remove_file, filename)
+        raise HTTPException(status_code=400, detail=str(e))
+    # Renditions are made after the response is sent
+    background_tasks.add_task(build_renditions, new.id, filename)
+    logging.info(f"Added picture by {user.email} >> {picture.filename}")
+    return {"details": f"{status.HTTP_201_CREATED, filename} Successfully added"}
 
 
 @router.get("/get/{picture_id}",
             status_code=status.HTTP_200_OK)
-async def get_pictures(picture_id: int,
+async def get_pictures(picture_id: int, request: Request,
+                       size: str | None = Query(default=None, regex=f"^({'|'.join(PICTURE_RENDITIONS)})$"),
                        session: AsyncSession = Depends(get_async_session)):
     """
-    Method to get all messages from the database.
-    :param user:
+    Method to get picture file.
+    :param picture_id:
+    :param size: rendition name (thumbnail, medium, large ...) - the original is served until it is ready
     :param session:
-    :return:
+    :return: file with ETag / Last-Modified, 304 when the client copy is fresh, 206 for a Range
     """
     try:
+        if size:
+            statement = select(PictureRendition).where(PictureRendition.picture_id == picture_id) \
+                .where(PictureRendition.name == size)
+            rendition = (await session.execute(statement)).scalars().first()
+            if rendition:
+                return await conditional_file_response(request, rendition.filename, rendition.media_type)
         statement = select(Picture).where(Picture.id == picture_id)
         results = await session.execute(statement)
         instance = results.scalars().first()
         if instance:
-            return FileResponse(str(instance.filename), media_type="image/png")
+            return await conditional_file_response(request, str(instance.filename),
+                                                   instance.media_type or guess_media_type(instance.filename),
+                                                   instance.content_hash)
             # return str("file:///Users/ewan/Desktop/dev/test_mango/static" + instance.filename.replace('.', ''))
         else:
             return {"details": f"{status.HTTP_404_NOT_FOUND} NOT FOUND"}
@@ -73,24 +111,27 @@ async def get_pictures(picture_id: int,
 
 @router.post("/get_resized",
              status_code=status.HTTP_200_OK)
-async def get_by_size_and_id(picture_id: int, size_h: int, size_v: int,
+async def get_by_size_and_id(picture_id: int, request: Request,
+                             size_h: int = Query(ge=1, le=PICTURE_RESIZE_MAX_SIDE),
+                             size_v: int = Query(ge=1, le=PICTURE_RESIZE_MAX_SIDE),
+                             image_format: str = Query(default="png", regex="^(png|jpeg|webp)$"),
                              session: AsyncSession = Depends(get_async_session)):
-    """ Method which returns resized picture"""
+    """ Method which returns resized picture - served from the derivative cache"""
     try:
         statement = select(Picture).where(Picture.id == picture_id)
         results = await session.execute(statement)
         instance = results.scalars().first()
-        if instance:
-            img = Image.open(instance.filename)
-            img_resize = img.resize((size_h, size_v))
-            with open(f"./static/pics/resized.png", "wb+") as buff:
-                img_resize.save(buff)
-            return FileResponse(str(buff.name), media_type="image/png")
-        else:
-            return {"details": f"{status.HTTP_404_NOT_FOUND} NOT FOUND"}
     except SQLAlchemyError as e:
-        logging.error(f"SQLAlchemyError: >> {e} \n {get_pictures.__name__}")
+        logging.error(f"SQLAlchemyError: >> {e} \n {get_by_size_and_id.__name__}")
         raise HTTPException(status_code=400, detail=str(e))
+    if not instance:
+        return {"details": f"{status.HTTP_404_NOT_FOUND} NOT FOUND"}
+    try:
+        path = await derivative_cache.get(instance.id, instance.filename, size_h, size_v, image_format)
+    except OSError as e:
+        logging.error(f"Resize failed: >> {e} \n {get_by_size_and_id.__name__}")
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Picture file is not available")
+    return await conditional_file_response(request, path, FORMATS[image_format][1])
 
 
 @router.delete("/delete/{picture_id}",
@@ -109,8 +150,14 @@ async def delete_picture(picture_id: int,
         results = await session.execute(statement)
         instance = results.scalars().first()
         if instance:
+            renditions = await session.execute(
+                select(PictureRendition.filename).where(PictureRendition.picture_id == picture_id))
+            rendition_files = renditions.scalars().all()
             await session.delete(instance)
             await session.commit()
+            derivative_cache.discard(picture_id)
+            for filename in rendition_files:
+                await run_in_threadpool(remove_file, filename)
             return {"details": f"{status.HTTP_200_OK} Successfully deleted"}
         else:
             return {"details": f"{status.HTTP_404_NOT_FOUND} Not found"}
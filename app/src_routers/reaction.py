@@ -1,21 +1,53 @@
-from fastapi import APIRouter, Depends, HTTPException
-from sqlalchemy import select
+from collections import Counter
+
+from fastapi import APIRouter, Depends, HTTPException, Query, Request
+from sqlalchemy import select, delete, update
+from sqlalchemy.dialects.postgresql import insert
 from sqlalchemy.exc import SQLAlchemyError
 from sqlalchemy.ext.asyncio import AsyncSession
 from starlette import status
 from app.db import get_async_session
-from app.models import User, Reaction
-from app.schemas import ReactionCreate, ReactionResponse
+from app.models import User, Reaction, ReactionCount, Message
+from app.schemas import ReactionCreate, ReactionResponse, ReactionSummaryResponse, ReactionImport
 from app.users import fastapi_users
 from fastapi_cache.decorator import cache
+from app.cache import tagged_key_builder, invalidate, invalidate_namespace, author_tag, chat_tag, message_tag, \
+    REACTIONS_NAMESPACE, MESSAGES_NAMESPACE
+from app.bulk_import import import_ndjson, Rows
 from settings import REDIS_CACHING_MIN
 
 current_user = fastapi_users.current_user(active=True)
+current_superuser = fastapi_users.current_user(active=True, superuser=True)
 
 router = APIRouter(
     responses={404: {"description": "Not found"}},
 )
 
+# Max message ids in one summary request
+SUMMARY_BATCH_LIMIT = 200
+
+
+async def change_count(session: AsyncSession, message_id: int, reaction_type: str, delta: int):
+    """ Move the reaction counter of the message, creating it on the first reaction"""
+    if delta > 0:
+        statement = insert(ReactionCount).values(message_id=message_id, type=reaction_type, count=delta)
+        statement = statement.on_conflict_do_update(
+            index_elements=[ReactionCount.message_id, ReactionCount.type],
+            set_={"count": ReactionCount.count + delta})
+    else:
+        statement = update(ReactionCount).where(ReactionCount.message_id == message_id) \
+            .where(ReactionCount.type == reaction_type).values(count=ReactionCount.count + delta)
+    await session.execute(statement)
+
+
+async def invalidate_reactions(session: AsyncSession, message_id: int, user_id: int):
+    """ Drop cached reactions of the message and the user, and message pages which show reaction counts"""
+    await invalidate(REACTIONS_NAMESPACE, message_tag(message_id), author_tag(user_id))
+    message = (await session.execute(
+        select(Message.chat_id, Message.author_id).where(Message.id == message_id))).first()
+    if message is not None:
+        await invalidate(MESSAGES_NAMESPACE, chat_tag(message.chat_id), author_tag(message.author_id))
+
 
 @router.post("/add",
              status_code=status.HTTP_201_CREATED)
@@ -30,18 +62,24 @@ async def add_reaction(user: User = Depends(current_user),
     :return: added entity
     """
     try:
-        new_reaction = Reaction(user_id=user.id,
-                                type=reaction.type,
-                                message_id=reaction.message_id)
-        # C H E C K  T H E   S A M E
-        _statement = select(Reaction).where(Reaction.user_id ==
-                                            user.id).where(Reaction.message_id == reaction.message_id)
-        _results = await session.execute(_statement)
-        from_db = _results.scalars().first()
-        if from_db is None:
-            session.add(new_reaction)
+        # No foreign key on the partitioned message table - archived messages take no reactions either
+        exists = await session.execute(select(Message.id).where(Message.id == reaction.message_id))
+        if exists.first() is None:
+            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Message not found")
+        # Unique (user_id, message_id) - a repeated reaction is dropped by the same statement
+        statement = insert(Reaction).values(user_id=user.id,
+                                            type=reaction.type,
+                                            message_id=reaction.message_id)
+        statement = statement.on_conflict_do_nothing(index_elements=[Reaction.user_id, Reaction.message_id])
+        reaction_id = (await session.execute(statement.returning(Reaction.id))).scalar_one_or_none()
+        if reaction_id is not None:
+            await change_count(session, reaction.message_id, reaction.type, 1)
             await session.commit()
-        return {"reaction": new_reaction}
+            await invalidate_reactions(session, reaction.message_id, user.id)
+        return {"reaction": {"id": reaction_id,
+                             "user_id": user.id,
+                             "type": reaction.type,
+                             "message_id": reaction.message_id}}
 
     except SQLAlchemyError as e:
         raise HTTPException(status_code=400, detail=str(e))
@@ -50,7 +88,8 @@ async def add_reaction(user: User = Depends(current_user),
 @router.get("/get",
             response_model=ReactionResponse,
             status_code=status.HTTP_200_OK)
-@cache(expire=REDIS_CACHING_MIN,namespace='reactions_cache_minute')
+@cache(expire=REDIS_CACHING_MIN,namespace=REACTIONS_NAMESPACE,
+       key_builder=tagged_key_builder(lambda kwargs: author_tag(kwargs["user"].id)))
 async def get_all_reactions(user: User = Depends(current_user),
                             session: AsyncSession = Depends(get_async_session)):
     """
@@ -72,7 +111,8 @@ async def get_all_reactions(user: User = Depends(current_user),
 @router.get("/get_by/{message_id}",
             response_model=ReactionResponse,
             status_code=status.HTTP_200_OK)
-@cache(expire=REDIS_CACHING_MIN,namespace='reactions_cache_minute')
+@cache(expire=REDIS_CACHING_MIN,namespace=REACTIONS_NAMESPACE,
+       key_builder=tagged_key_builder(lambda kwargs: message_tag(kwargs["message_id"])))
 async def get_all_reactions_message_id(message_id: int, user: User = Depends(current_user),
                                        session: AsyncSession = Depends(get_async_session)):
     """
@@ -106,14 +146,118 @@ async def delete_reactions(reaction_id: int, user: User = Depends(current_user),
     """
     try:
         execution = await session.execute(
-            select(Reaction).where(Reaction.id == reaction_id).where(Reaction.user_id == user.id))
-        item = execution.scalars().first()
+            delete(Reaction).where(Reaction.id == reaction_id).where(Reaction.user_id == user.id)
+            .returning(Reaction.message_id, Reaction.type))
+        item = execution.first()
         if item is not None:
-            await session.delete(item)
+            await change_count(session, item.message_id, item.type, -1)
             await session.commit()
+            await invalidate_reactions(session, item.message_id, user.id)
         else:
             raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Item not found")
 
         return {'details': "deleted successfully"}
     except SQLAlchemyError as e:
         raise HTTPException(status_code=400, detail=str(e))
+
+
+@router.get("/summary",
+            response_model=ReactionSummaryResponse,
+            status_code=status.HTTP_200_OK)
+async def get_reaction_summaries(message_ids: list[int] = Query(max_items=SUMMARY_BATCH_LIMIT),
+                                 user: User = Depends(current_user),
+                                 session: AsyncSession = Depends(get_async_session)):
+    """
+    Method to get reaction counts by type and own reaction for many messages at once.
+    :param message_ids: ?message_ids=1&message_ids=2
+    :param user:
+    :param session:
+    :return: Summaries in the order of message_ids
+    """
+    try:
+        counts = await session.execute(
+            select(ReactionCount).where(ReactionCount.message_id.in_(message_ids))
+            .where(ReactionCount.count > 0))
+        mine = await session.execute(
+            select(Reaction.message_id, Reaction.type).where(Reaction.user_id == user.id)
+            .where(Reaction.message_id.in_(message_ids)))
+    except SQLAlchemyError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    summaries = {message_id: {"message_id": message_id, "counts": {}, "mine": None} for message_id in message_ids}
+    for counter in counts.scalars():
+        summaries[counter.message_id]["counts"][counter.type] = counter.count
+    for message_id, reaction_type in mine:
+        summaries[message_id]["mine"] = reaction_type
+    return {"summaries": list(summaries.values())}
+
+
+@router.get("/summary/{message_id}",
+            response_model=ReactionSummaryResponse,
+            status_code=status.HTTP_200_OK)
+async def get_reaction_summary(message_id: int, user: User = Depends(current_user),
+                               session: AsyncSession = Depends(get_async_session)):
+    """
+    Method to get reaction counts by type and own reaction for one message.
+    :param message_id:
+    :param user:
+    :param session:
+    :return: Summary
+    """
+    return await get_reaction_summaries(message_ids=[message_id], user=user, session=session)
+
+
+async def write_reactions(session: AsyncSession, rows: Rows) -> tuple[int, int, list[dict]]:
+    """
+    Import chunk writer - one multi-row insert skipping existing (user_id, message_id) reactions,
+    then one multi-row upsert of the counters for the rows actually inserted.
+    Rows of unknown users or messages are rejected up front.
+    """
+    users = {row.user_id for _, row in rows}
+    messages = {row.message_id for _, row in rows}
+    known_users = set((await session.execute(select(User.id).where(User.id.in_(users)))).scalars())
+    known_messages = set((await session.execute(select(Message.id).where(Message.id.in_(messages)))).scalars())
+    errors = []
+    # Last reaction of a user to a message wins inside the chunk, as the unique constraint allows one
+    values = {}
+    for line, row in rows:
+        if row.user_id not in known_users:
+            errors.append({"line": line, "error": f"Unknown user_id {row.user_id}"})
+        elif row.message_id not in known_messages:
+            errors.append({"line": line, "error": f"Unknown message_id {row.message_id}"})
+        else:
+            values[(row.user_id, row.message_id)] = {"user_id": row.user_id, "type": row.type,
+                                                     "message_id": row.message_id}
+    if not values:
+        return 0, 0, errors
+    statement = insert(Reaction).values(list(values.values()))
+    statement = statement.on_conflict_do_nothing(index_elements=[Reaction.user_id, Reaction.message_id])
+    inserted = (await session.execute(statement.returning(Reaction.message_id, Reaction.type))).all()
+    counts = Counter((message_id, reaction_type) for message_id, reaction_type in inserted)
+    if counts:
+        statement = insert(ReactionCount).values([{"message_id": message_id, "type": reaction_type, "count": count}
+                                                  for (message_id, reaction_type), count in counts.items()])
+        statement = statement.on_conflict_do_update(
+            index_elements=[ReactionCount.message_id, ReactionCount.type],
+            set_={"count": ReactionCount.count + statement.excluded.count})
+        await session.execute(statement)
+    return len(inserted), len(rows) - len(errors) - len(inserted), errors
+
+
+@router.post("/import",
+             status_code=status.HTTP_200_OK)
+async def import_reactions(request: Request, user: User = Depends(current_superuser)):
+    """
+    Method to bulk import reactions - NDJSON body, one reaction per line:
+    {"user_id": 1, "message_id": 10, "type": "like"}
+    Rows are validated and written chunk by chunk, each chunk in its own transaction,
+    reaction counters move in the same transaction.
+    :param request:
+    :param user: superuser only
+    :return: inserted and duplicate totals and a report per chunk
+    """
+    report = await import_ndjson(request, ReactionImport, write_reactions)
+    if report["inserted"]:
+        await invalidate_namespace(REACTIONS_NAMESPACE)
+        await invalidate_namespace(MESSAGES_NAMESPACE)
+    return report
@@ -1,15 +1,20 @@
+import json
 import logging
-from fastapi import APIRouter, Depends, HTTPException
+from fastapi import APIRouter, Depends, HTTPException, Query
 from sqlalchemy import select
 from sqlalchemy.exc import SQLAlchemyError
 from sqlalchemy.ext.asyncio import AsyncSession
 from starlette import status
+from starlette.responses import StreamingResponse
 from datetime import datetime as dt
 from app.models import User, Release
 from app.schemas import ReleaseCreate
 from app.users import fastapi_users
-from app.db import get_async_session
-from settings import root_dir
+from app.db import get_async_session, async_session_maker
+from app.pagination import decode_cursor, paginate
+from app.release_search import release_search
+from app.release_stats import change_stats, read_stats, DIMENSIONS
+from settings import root_dir, RELEASE_PAGE_SIZE, RELEASE_PAGE_SIZE_MAX, RELEASE_EXPORT_BATCH
 
 # Logger configuration
 logging.basicConfig(filename=f'{root_dir}/logs/release_logger.log', encoding='utf-8', level=logging.INFO)
@@ -21,6 +26,25 @@ router = APIRouter(
     responses={404: {"description": "Not found"}},
 )
 
+RELEASE_COLUMNS = {name: column for name, column in Release.__table__.c.items() if name != "search_vector"}
+# Listing leaves out the large story_text unless it is asked for in fields=
+LIST_FIELDS = [name for name in RELEASE_COLUMNS if name != "story_text"]
+
+
+def release_columns(fields: str | None) -> list:
+    """
+    Columns for fields= projection, id is always included.
+    :param fields: comma separated column names, None - LIST_FIELDS
+    :return: table columns
+    """
+    names = [name.strip() for name in fields.split(",") if name.strip()] if fields else LIST_FIELDS
+    unknown = [name for name in names if name not in RELEASE_COLUMNS]
+    if unknown:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=f"Unknown fields: {', '.join(unknown)}")
+    if "id" not in names:
+        names = ["id"] + names
+    return [RELEASE_COLUMNS[name] for name in names]
+
 
 @router.post("/add",
              status_code=status.HTTP_201_CREATED,response_model_exclude_unset=True)
@@ -40,10 +64,12 @@ async def add_release(release: ReleaseCreate,
                               filename=release.filename,
                               cover_id=release.cover_id)
         session.add(new_release)
+        await change_stats(session, new_release, 1)
         await session.commit()
     except SQLAlchemyError as e:
         logging.error(f"SQLAlchemyError: >> {e} \n {add_release.__name__}")
         raise HTTPException(status_code=400, detail=str(e))
+    release_search.index(new_release)
     logging.info(f"Added release >> {release.name} by {user.id}")
     return {"details": f"{status.HTTP_201_CREATED, release.name} Successfully added"}
 
@@ -95,27 +121,95 @@ async def get_release_name(release_name: str,
         raise HTTPException(status_code=400, detail=str(e))
 
 
+@router.get("/search",
+            status_code=status.HTTP_200_OK)
+async def search_releases(q: str = Query(min_length=1, max_length=200),
+                          limit: int = Query(default=20, ge=1, le=100),
+                          session: AsyncSession = Depends(get_async_session)):
+    """
+    Method to search releases by name, artists, genre, record label and story text.
+    Ranked by relevance, words match as prefixes, small typos are tolerated.
+    :param q: search text
+    :param limit: max results
+    :param session:
+    :return: releases with rank, best first
+    """
+    try:
+        return {"releases": await release_search.search(session, q, limit)}
+    except SQLAlchemyError as e:
+        logging.error(f"SQLAlchemyError: >> {e} \n {search_releases.__name__}")
+        raise HTTPException(status_code=400, detail=str(e))
+
+
+@router.get("/stats",
+            status_code=status.HTTP_200_OK)
+async def get_release_stats(dimension: str | None = Query(default=None, regex=f"^({'|'.join(DIMENSIONS)})$"),
+                            session: AsyncSession = Depends(get_async_session)):
+    """
+    Method to get release counts by genre, record label and month.
+    :param dimension: genre, record_label or month - all when not set
+    :param session:
+    :return: {dimension: {bucket: count}}
+    """
+    try:
+        return await read_stats(session, dimension)
+    except SQLAlchemyError as e:
+        logging.error(f"SQLAlchemyError: >> {e} \n {get_release_stats.__name__}")
+        raise HTTPException(status_code=400, detail=str(e))
+
+
 @router.get("/get_all",
             status_code=status.HTTP_200_OK)
-async def get_release_all(session: AsyncSession = Depends(get_async_session)):
+async def get_release_all(limit: int = Query(default=RELEASE_PAGE_SIZE, ge=1, le=RELEASE_PAGE_SIZE_MAX),
+                          cursor: str | None = None,
+                          fields: str | None = None,
+                          session: AsyncSession = Depends(get_async_session)):
     """
-    Method to get all releases.
+    Method to get releases page by page, in id order.
+    :param limit: page size
+    :param cursor: "next" value from the previous page
+    :param fields: comma separated columns, all but story_text by default
     :param session:
-    :return:
+    :return: releases and cursor of the next page
     """
+    columns = release_columns(fields)
     try:
-        statement = select(Release)
+        statement = select(*columns)
+        if cursor:
+            statement = statement.where(Release.id > decode_cursor(cursor))
+        statement = statement.order_by(Release.id).limit(limit + 1)
         results = await session.execute(statement)
-        instances = results.scalars().all()
-        if instances:
-            return instances
-        else:
-            return {"details": f"{status.HTTP_404_NOT_FOUND} NOT FOUND"}
+        rows, next_cursor = paginate(results.all(), limit)
+        return {"releases": [dict(row._mapping) for row in rows], "next": next_cursor}
     except SQLAlchemyError as e:
-        logging.error(f"SQLAlchemyError: >> {e} \n {get_release_name.__name__}")
+        logging.error(f"SQLAlchemyError: >> {e} \n {get_release_all.__name__}")
         raise HTTPException(status_code=400, detail=str(e))
 
 
+async def export_rows(columns: list):
+    """ NDJSON lines out of a server-side cursor - memory stays flat whatever the catalog size"""
+    async with async_session_maker() as session:
+        try:
+            statement = select(*columns).order_by(Release.id).execution_options(yield_per=RELEASE_EXPORT_BATCH)
+            results = await session.stream(statement)
+            async for partition in results.partitions():
+                yield "".join(json.dumps(dict(row._mapping), default=str) + "\n" for row in partition)
+        except SQLAlchemyError as e:
+            logging.error(f"SQLAlchemyError: >> {e} \n {export_rows.__name__}")
+            raise
+
+
+@router.get("/export",
+            status_code=status.HTTP_200_OK)
+async def export_releases(fields: str | None = None):
+    """
+    Method to stream the whole catalog as NDJSON - one release per line.
+    :param fields: comma separated columns, all but story_text by default
+    :return: application/x-ndjson stream
+    """
+    return StreamingResponse(export_rows(release_columns(fields)), media_type="application/x-ndjson")
+
+
 
 
 
@@ -144,7 +238,9 @@ async def delete_release(release_id: int,
         instance = results.scalars().first()
         if instance:
             await session.delete(instance)
+            await change_stats(session, instance, -1)
             await session.commit()
+            release_search.remove(release_id)
             return {"details": f"{status.HTTP_200_OK} Successfully deleted"}
         else:
             return {"details": f"{status.HTTP_404_NOT_FOUND} Not found"}
@@ -1,7 +1,14 @@
+import asyncio
+
 from fastapi import WebSocket, WebSocketDisconnect, APIRouter, Depends
+from starlette import status
 from fastapi.responses import HTMLResponse
 from sqlalchemy.sql.functions import current_user
 
+from app.backplane import Backplane, InMemoryBackplane
+from app.message_buffer import message_buffer
+from settings import SOCKET_SEND_QUEUE_SIZE, SOCKET_OVERFLOW_POLICY
+
 router = APIRouter(
 
 )
@@ -44,23 +51,116 @@ html = """
 """
 
 
+class Connection:
+    """
+    Single websocket with its own bounded outgoing queue.
+    A writer task drains the queue, so a slow client never blocks the sender.
+    """
+
+    def __init__(self, websocket: WebSocket, max_queue: int):
+        self.websocket = websocket
+        self.queue: asyncio.Queue[str] = asyncio.Queue(maxsize=max_queue)
+        self.writer = asyncio.create_task(self._write())
+
+    async def _write(self):
+        try:
+            while True:
+                message = await self.queue.get()
+                await self.websocket.send_text(message)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            # Socket is gone, the receive loop will clean up
+            return
+
+    def put(self, message: str, policy: str) -> bool:
+        """
+        Enqueue message without waiting.
+        :param message:
+        :param policy: "drop" - drop the oldest queued message, "disconnect" - give up on the client
+        :return: False when the client must be disconnected
+        """
+        try:
+            self.queue.put_nowait(message)
+        except asyncio.QueueFull:
+            if policy == "disconnect":
+                return False
+            self.queue.get_nowait()
+            self.queue.put_nowait(message)
+        return True
+
+    async def close(self, code: int = status.WS_1000_NORMAL_CLOSURE):
+        self.writer.cancel()
+        try:
+            await self.websocket.close(code=code)
+        except Exception:
+            pass
+
+
 class ConnectionManager:
-    def __init__(self):
-        self.active_connections: list[WebSocket] = []
+    """
+    Connections indexed by chat_id - broadcast only reaches members of the room.
+    Room messages go through the backplane, so members connected to other workers get them too.
+    """
+
+    def __init__(self, backplane: Backplane | None = None,
+                 max_queue: int = SOCKET_SEND_QUEUE_SIZE, policy: str = SOCKET_OVERFLOW_POLICY):
+        self.backplane = backplane or InMemoryBackplane()
+        self.max_queue = max_queue
+        self.policy = policy
+        self.rooms: dict[str, dict[WebSocket, Connection]] = {}
 
-    async def connect(self, websocket: WebSocket):
+    async def connect(self, websocket: WebSocket, chat_id: str):
         await websocket.accept()
-        self.active_connections.append(websocket)
+        room = self.rooms.get(chat_id)
+        if room is None:
+            room = self.rooms[chat_id] = {}
+            await self.backplane.subscribe(chat_id, self._on_message)
+        room[websocket] = Connection(websocket, self.max_queue)
+
+    async def disconnect(self, websocket: WebSocket, chat_id: str):
+        if self._remove(websocket, chat_id):
+            await self.backplane.unsubscribe(chat_id, self._on_message)
+
+    def _remove(self, websocket: WebSocket, chat_id: str) -> bool:
+        """ Forget the socket, returns True when the room became empty"""
+        room = self.rooms.get(chat_id)
+        if room is None:
+            return False
+        connection = room.pop(websocket, None)
+        if connection is not None:
+            connection.writer.cancel()
+        if room:
+            return False
+        del self.rooms[chat_id]
+        return True
+
+    async def send_personal_message(self, message: str, websocket: WebSocket, chat_id: str):
+        connection = self.rooms.get(chat_id, {}).get(websocket)
+        if connection is not None:
+            self._deliver(connection, message, chat_id)
+
+    async def broadcast(self, message: str, chat_id: str):
+        await self.backplane.publish(chat_id, message)
+
+    async def _on_message(self, chat_id: str, message: str):
+        for connection in list(self.rooms.get(chat_id, {}).values()):
+            self._deliver(connection, message, chat_id)
 
-    def disconnect(self, websocket: WebSocket):
-        self.active_connections.remove(websocket)
+    def _deliver(self, connection: Connection, message: str, chat_id: str):
+        if not connection.put(message, self.policy):
+            asyncio.create_task(self._evict(connection, chat_id))
 
-    async def send_personal_message(self, message: str, websocket: WebSocket):
-        await websocket.send_text(message)
+    async def _evict(self, connection: Connection, chat_id: str):
+        await self.disconnect(connection.websocket, chat_id)
+        await connection.close(code=status.WS_1013_TRY_AGAIN_LATER)
 
-    async def broadcast(self, message: str):
-        for connection in self.active_connections:
-            await connection.send_text(message)
+    async def close(self):
+        for chat_id, room in list(self.rooms.items()):
+            for connection in list(room.values()):
+                await connection.close(code=status.WS_1001_GOING_AWAY)
+        self.rooms.clear()
+        await self.backplane.close()
 
 
 manager = ConnectionManager()
@@ -73,13 +173,16 @@ async def get():
 
 @router.websocket("/chat/{chat_id}")
 async def websocket_endpoint(websocket: WebSocket, chat_id: str):
-    await manager.connect(websocket)
+    await manager.connect(websocket, chat_id)
     try:
         while True:
             data = await websocket.receive_text()
-            print(data)
-            await manager.send_personal_message(f"You wrote: {data}", websocket)
-            await manager.broadcast(f"Client #{chat_id} says: {data}")
+            if chat_id.isdigit():
+                message_buffer.add(body=data, chat_id=int(chat_id))
+            await manager.send_personal_message(f"You wrote: {data}", websocket, chat_id)
+            await manager.broadcast(f"Client #{chat_id} says: {data}", chat_id)
     except WebSocketDisconnect:
-        manager.disconnect(websocket)
-        await manager.broadcast(f"Client #{chat_id} left the chat")
\ No newline at end of file
+        await manager.broadcast(f"Client #{chat_id} left the chat", chat_id)
+    finally:
+        # A failed publish or a socket closed by _evict leaves the room too
+        await manager.disconnect(websocket, chat_id)
@@ -0,0 +1,69 @@
+import logging
+import time
+from collections import OrderedDict
+
+from sqlalchemy import inspect
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import make_transient_to_detached
+
+from app.cache_backend import INVALIDATION_CHANNEL
+from app.models import User
+from settings import AUTH_USER_CACHE_TTL, AUTH_USER_CACHE_SIZE
+
+# Invalidation target of a user on the fastapi-cache pub/sub channel
+USER_TARGET_PREFIX = "auth-user:"
+
+
+class UserCache:
+    """
+    Short TTL cache of users resolved from a verified JWT, keyed by token subject (user id).
+    Keeps the auth hot path off the database - entries are dropped on every worker when the user changes.
+    Column values are cached, each request gets its own User merged into its session.
+    """
+
+    def __init__(self, ttl: float = AUTH_USER_CACHE_TTL, max_size: int = AUTH_USER_CACHE_SIZE):
+        self.ttl = ttl
+        self.max_size = max_size
+        # subject -> (expires at, column values), least recently used first
+        self.entries: OrderedDict[str, tuple[float, dict]] = OrderedDict()
+        # Publishes invalidations to the other workers - set at startup
+        self.redis = None
+
+    async def get(self, subject: str, session: AsyncSession) -> User | None:
+        entry = self.entries.get(subject)
+        if entry is None:
+            return None
+        expires, values = entry
+        if time.monotonic() >= expires:
+            del self.entries[subject]
+            return None
+        self.entries.move_to_end(subject)
+        user = User(**values)
+        make_transient_to_detached(user)
+        return await session.merge(user, load=False)
+
+    def set(self, subject: str, user: User):
+        if self.ttl <= 0:
+            return
+        values = {column.key: getattr(user, column.key) for column in inspect(User).column_attrs}
+        self.entries[subject] = (time.monotonic() + self.ttl, values)
+        self.entries.move_to_end(subject)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def drop(self, target: str):
+        """ Pub/sub listener - target of any cache, only user targets are ours"""
+        if target.startswith(USER_TARGET_PREFIX):
+            self.entries.pop(target[len(USER_TARGET_PREFIX):], None)
+
+    async def invalidate(self, subject):
+        self.entries.pop(str(subject), None)
+        if self.redis is None:
+            return
+        try:
+            await self.redis.publish(INVALIDATION_CHANNEL, f"{USER_TARGET_PREFIX}{subject}")
+        except Exception as e:
+            logging.error(f"User cache invalidation publish failed: >> {e} \n {subject}")
+
+
+user_cache = UserCache()
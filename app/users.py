@@ -1,12 +1,17 @@
 import uuid
 from typing import Optional
 from fastapi import Depends, Request
-from fastapi_users import BaseUserManager, FastAPIUsers, IntegerIDMixin
+import jwt
+from fastapi.security import OAuth2PasswordRequestForm
+from fastapi_users import BaseUserManager, FastAPIUsers, IntegerIDMixin, exceptions, models, schemas
 from fastapi_users.authentication import AuthenticationBackend, BearerTransport, JWTStrategy
+from fastapi_users.jwt import decode_jwt
 
 from fastapi_users.db import SQLAlchemyUserDatabase
 from app.db import get_user_db
 from app.models import User
+from app.passwords import password_hasher
+from app.user_cache import user_cache
 from settings import AUTH_SECRET_KEY
 
 SECRET = AUTH_SECRET_KEY
@@ -17,6 +22,47 @@ class UserManager(IntegerIDMixin, BaseUserManager[User, int]):
     reset_password_token_secret = SECRET
     verification_token_secret = SECRET
 
+    # bcrypt runs in password_hasher threads - the library would hash on the event loop
+    async def create(self, user_create: schemas.UC, safe: bool = False, request: Optional[Request] = None) -> User:
+        """ BaseUserManager.create - the existing user check comes before the costly hash"""
+        await self.validate_password(user_create.password, user_create)
+        if await self.user_db.get_by_email(user_create.email) is not None:
+            raise exceptions.UserAlreadyExists()
+        user_dict = user_create.create_update_dict() if safe else user_create.create_update_dict_superuser()
+        user_dict["hashed_password"] = await password_hasher.hash_async(user_dict.pop("password"))
+        created_user = await self.user_db.create(user_dict)
+        await self.on_after_register(created_user, request)
+        return created_user
+
+    async def _update(self, user: User, update_dict: dict) -> User:
+        password = update_dict.get("password")
+        if password is None:
+            return await super()._update(user, update_dict)
+        await self.validate_password(password, user)
+        # The library takes hashed_password as a plain field - no second validation or hash
+        update_dict = {field: value for field, value in update_dict.items() if field != "password"}
+        update_dict["hashed_password"] = await password_hasher.hash_async(password)
+        return await super()._update(user, update_dict)
+
+    async def authenticate(self, credentials: OAuth2PasswordRequestForm) -> Optional[User]:
+        try:
+            user = await self.get_by_email(credentials.username)
+        except exceptions.UserNotExists:
+            # Run the hasher anyway to mitigate timing attack
+            await password_hasher.hash_async(credentials.password)
+            return None
+
+        verified, updated_password_hash = await password_hasher.verify_and_update_async(
+            credentials.password, user.hashed_password)
+        if not verified:
+            return None
+        # Hash made with an outdated cost - store the upgraded one
+        if updated_password_hash is not None:
+            await self.user_db.update(user, {"hashed_password": updated_password_hash})
+            await user_cache.invalidate(user.id)
+
+        return user
+
     async def on_after_register(self, user: User, request: Optional[Request] = None):
         print(f"User {user.id} has registered.")
 
@@ -30,16 +76,57 @@ class UserManager(IntegerIDMixin, BaseUserManager[User, int]):
     ):
         print(f"Verification requested for user {user.id}. Verification token: {token}")
 
+    # Cached users must not outlive changes made through the /users and /auth routers
+    async def on_after_update(self, user: User, update_dict: dict, request: Optional[Request] = None):
+        await user_cache.invalidate(user.id)
+
+    async def on_after_verify(self, user: User, request: Optional[Request] = None):
+        await user_cache.invalidate(user.id)
+
+    async def on_after_reset_password(self, user: User, request: Optional[Request] = None):
+        await user_cache.invalidate(user.id)
+
+    async def on_after_delete(self, user: User, request: Optional[Request] = None):
+        await user_cache.invalidate(user.id)
+
 
 async def get_user_manager(user_db: SQLAlchemyUserDatabase = Depends(get_user_db)):
-    yield UserManager(user_db)
+    yield UserManager(user_db, password_hasher)
 
 
 bearer_transport = BearerTransport(tokenUrl="auth/jwt/login")
 
 
+class CachedJWTStrategy(JWTStrategy):
+    """
+    JWT strategy which verifies the token on every call but takes the user from user_cache,
+    the database is queried only on a cache miss.
+    """
+
+    async def read_token(self, token: Optional[str], user_manager: BaseUserManager[models.UP, models.ID]):
+        if token is None:
+            return None
+        try:
+            data = decode_jwt(token, self.decode_key, self.token_audience, algorithms=[self.algorithm])
+            subject = data.get("sub")
+            if subject is None:
+                return None
+        except jwt.PyJWTError:
+            return None
+
+        user = await user_cache.get(subject, user_manager.user_db.session)
+        if user is not None:
+            return user
+        try:
+            user = await user_manager.get(user_manager.parse_id(subject))
+        except (exceptions.UserNotExists, exceptions.InvalidID):
+            return None
+        user_cache.set(subject, user)
+        return user
+
+
 def get_jwt_strategy() -> JWTStrategy:
-    return JWTStrategy(secret=SECRET, lifetime_seconds=3600)
+    return CachedJWTStrategy(secret=SECRET, lifetime_seconds=3600)
 
 
 auth_backend = AuthenticationBackend(
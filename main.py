@@ -2,10 +2,11 @@
 import uvicorn
 from fastapi import Depends, FastAPI
 from app.models import User
-from app.db import create_db_and_tables, drop_db_and_tables, drop_table
+from app.db import create_db_and_tables, drop_db_and_tables, drop_table, warm_up_pool, pool_metrics
 from app.schemas import UserCreate, UserRead, UserUpdate
 from app.users import auth_backend, current_active_user, fastapi_users
-from settings import SENTRY_DSN, SENTRY_TRACES_SAMPLE_RATE
+from app.passwords import password_hasher
+from settings import SENTRY_DSN, SENTRY_TRACES_SAMPLE_RATE, DB_DEBUG_STATEMENTS
 import sentry_sdk
 
 # R O U T E R S
@@ -14,13 +15,23 @@ from app.src_routers.reaction import router as reaction_router
 from app.src_routers.releases import router as release_router
 from app.src_routers.message import router as message_router
 from app.src_routers.chatgpt import router as chat_gpt_router
-from app.src_routers.soсketpoint import router as socket_router
+from app.src_routers.chats import router as chats_router
+from app.src_routers.soсketpoint import router as socket_router, manager as socket_manager
 
 from fastapi_cache import FastAPICache
-from fastapi_cache.backends.redis import RedisBackend
 from fastapi_cache.decorator import cache
 
 from redis import asyncio as aioredis
+from app.backplane import RedisBackplane
+from app.message_buffer import message_buffer
+from app.image_cache import shutdown_pool
+from app.release_search import release_search
+from app.cache_backend import TwoTierBackend
+from app.user_cache import user_cache
+from app.openai_client import openai_client
+from app.prompt_cache import prompt_cache, model_list
+from app.message_partitions import message_partitions
+from app.image_jobs import fail_interrupted_jobs
 
 
 
@@ -33,6 +44,10 @@ sentry_sdk.init(
 
 app = FastAPI(title="Hexrec backend", version="0.1.0")
 
+if DB_DEBUG_STATEMENTS:
+    from app.query_debug import statement_counter_middleware
+    app.middleware("http")(statement_counter_middleware)
+
 # AUTHENTICATION ROUTERS
 
 
@@ -65,6 +80,7 @@ app.include_router(pictures_router, prefix="/pictures", tags=["User Pictures API
 app.include_router(reaction_router, prefix="/reactions", tags=["User Reaction API"])
 app.include_router(release_router, prefix="/releases", tags=["Artist Releases  API"])
 app.include_router(message_router, prefix="/private", tags=["Message API"])
+app.include_router(chats_router, prefix="/chats", tags=["Chat List API"])
 app.include_router(chat_gpt_router, prefix="/prompt", tags=["Chat GPT API"])
 app.include_router(socket_router, prefix="/socket", tags=["Web Socket API"])
 
@@ -79,9 +95,11 @@ async def drop_route(command: str):
     match command:
         case "drop_all":
             await drop_db_and_tables()
+            message_partitions.known.clear()
             return {"Message": "Database and tables dropped"}
         case "create_all":
             await create_db_and_tables()
+            await message_partitions.premake_partitions()
             return {"Message": "Database and new tables migrated"}
         case _:
             await drop_table(table_name=command)
@@ -93,14 +111,59 @@ def get_current_user(user: User = Depends(current_user)):
     return {"user_id":user.id, "name":user.name, "surname":user.surname, "email": user.email, "phone":user.phone_number}
 
 
+@app.get("/cache_stats", tags=["Cache hit / miss counters by namespace"])
+async def get_cache_stats(user: User = Depends(current_user)):
+    return FastAPICache.get_backend().stats()
+
+
+@app.get("/db_pool_stats", tags=["Database pool metrics"])
+async def get_db_pool_stats(user: User = Depends(current_user)):
+    return pool_metrics()
+
+
+@app.get("/password_hash_stats", tags=["Password hashing metrics"])
+async def get_password_hash_stats(user: User = Depends(current_user)):
+    return password_hasher.metrics()
+
+
+@app.get("/prompt_cache_stats", tags=["Prompt cache metrics"])
+async def get_prompt_cache_stats(user: User = Depends(current_user)):
+    return prompt_cache.metrics()
+
+
 # @app.on_event("startup")
 # async def on_startup():
 #     await create_db_and_tables()
 
 @app.on_event("startup")
 async def startup():
+    await warm_up_pool()
+    await fail_interrupted_jobs()
     redis = aioredis.from_url("redis://localhost")
-    FastAPICache.init(RedisBackend(redis), prefix="fastapi-cache")
+    cache_backend = TwoTierBackend(redis)
+    await cache_backend.start()
+    FastAPICache.init(cache_backend, prefix="fastapi-cache")
+    # Cached auth users are dropped on every worker
+    user_cache.redis = redis
+    cache_backend.listeners.append(user_cache.drop)
+    # Web socket rooms shared between workers
+    socket_manager.backplane = RedisBackplane(redis)
+    # Message partitions ahead of time before the buffer writes into them
+    await message_partitions.start()
+    await message_buffer.start()
+    await release_search.rebuild()
+    model_list.start()
+
+
+@app.on_event("shutdown")
+async def shutdown():
+    await FastAPICache.get_backend().close()
+    await socket_manager.close()
+    await message_buffer.close()
+    await message_partitions.close()
+    shutdown_pool()
+    await model_list.close()
+    await openai_client.close()
 
 
 if __name__ == "__main__":
@@ -30,3 +30,117 @@ REDIS_CACHING_DAY = config["REDIS_CACHING_DAY"]
 REDIS_CACHING_HOUR = config["REDIS_CACHING_HOUR"]
 REDIS_CACHING_MIN = config["REDIS_CACHING_MIN"]
 
+# Web socket chat: per connection outgoing queue and overflow policy ("drop" or "disconnect")
+SOCKET_SEND_QUEUE_SIZE = int(config.get("SOCKET_SEND_QUEUE_SIZE", 100))
+SOCKET_OVERFLOW_POLICY = config.get("SOCKET_OVERFLOW_POLICY", "drop")
+
+# Write-behind buffer for chat messages: flush size, flush interval (seconds), max pending rows
+MESSAGE_BUFFER_SIZE = int(config.get("MESSAGE_BUFFER_SIZE", 500))
+MESSAGE_BUFFER_INTERVAL = float(config.get("MESSAGE_BUFFER_INTERVAL", 1.0))
+MESSAGE_BUFFER_LIMIT = int(config.get("MESSAGE_BUFFER_LIMIT", 50000))
+
+# Message history pages: default and maximum page size
+MESSAGE_PAGE_SIZE = int(config.get("MESSAGE_PAGE_SIZE", 50))
+MESSAGE_PAGE_SIZE_MAX = int(config.get("MESSAGE_PAGE_SIZE_MAX", 500))
+
+# Debug: count SQL statements per request and warn about repeated ones (N+1)
+DB_DEBUG_STATEMENTS = config.get("DB_DEBUG_STATEMENTS", "false").lower() == "true"
+DB_N_PLUS_ONE_THRESHOLD = int(config.get("DB_N_PLUS_ONE_THRESHOLD", 5))
+
+# Picture uploads: max size and read chunk in bytes
+PICTURE_MAX_SIZE = int(config.get("PICTURE_MAX_SIZE", 10 * 1024 * 1024))
+PICTURE_CHUNK_SIZE = int(config.get("PICTURE_CHUNK_SIZE", 1024 * 1024))
+
+# Resized picture cache: directory, disk budget in bytes, resize processes, max side in pixels
+PICTURE_CACHE_DIR = config.get("PICTURE_CACHE_DIR", f"{root_dir}/static/cache")
+PICTURE_CACHE_MAX_BYTES = int(config.get("PICTURE_CACHE_MAX_BYTES", 256 * 1024 * 1024))
+PICTURE_RESIZE_WORKERS = int(config.get("PICTURE_RESIZE_WORKERS", 2))
+PICTURE_RESIZE_MAX_SIDE = int(config.get("PICTURE_RESIZE_MAX_SIDE", 4096))
+
+# Picture renditions made after upload: "name:max side in pixels" list and format (webp or jpeg)
+PICTURE_RENDITIONS = {name: int(side) for name, side in
+                      (item.split(":") for item in
+                       config.get("PICTURE_RENDITIONS", "thumbnail:160,medium:640,large:1280").split(","))}
+PICTURE_RENDITION_FORMAT = config.get("PICTURE_RENDITION_FORMAT", "webp")
+PICTURE_RENDITION_DIR = config.get("PICTURE_RENDITION_DIR", f"{root_dir}/static/renditions")
+
+# Cache-Control of picture responses - "no-cache" keeps the copy and revalidates it with ETag / Last-Modified
+PICTURE_CACHE_CONTROL = config.get("PICTURE_CACHE_CONTROL", "public, no-cache")
+
+# Release catalog pages and NDJSON export batch (rows per server-side cursor fetch)
+RELEASE_PAGE_SIZE = int(config.get("RELEASE_PAGE_SIZE", 50))
+RELEASE_PAGE_SIZE_MAX = int(config.get("RELEASE_PAGE_SIZE_MAX", 500))
+RELEASE_EXPORT_BATCH = int(config.get("RELEASE_EXPORT_BATCH", 1000))
+
+# Release search backend: "postgres" (tsvector + pg_trgm indexes) or "memory" (in-process inverted index)
+RELEASE_SEARCH_BACKEND = config.get("RELEASE_SEARCH_BACKEND", "postgres")
+
+# Two tier cache: local entries, local TTL cap (seconds), stale-while-revalidate window (0 - off), miss lock timeout
+CACHE_LOCAL_MAX_ENTRIES = int(config.get("CACHE_LOCAL_MAX_ENTRIES", 10000))
+CACHE_LOCAL_TTL = float(config.get("CACHE_LOCAL_TTL", 5))
+CACHE_STALE_TTL = int(config.get("CACHE_STALE_TTL", 0))
+CACHE_LOCK_TIMEOUT = float(config.get("CACHE_LOCK_TIMEOUT", 3))
+
+# Database pool
+DB_POOL_SIZE = int(config.get("DB_POOL_SIZE", 10))
+DB_MAX_OVERFLOW = int(config.get("DB_MAX_OVERFLOW", 20))
+DB_POOL_TIMEOUT = float(config.get("DB_POOL_TIMEOUT", 30))
+DB_POOL_RECYCLE = int(config.get("DB_POOL_RECYCLE", 1800))
+# Pre-ping costs a round trip on every checkout - off, pool_recycle retires old connections;
+# turn it on behind a proxy or failover which drops idle connections
+DB_POOL_PRE_PING = config.get("DB_POOL_PRE_PING", "false").lower() == "true"
+# Connections opened on startup, 0 - no warm up
+DB_POOL_WARMUP = int(config.get("DB_POOL_WARMUP", DB_POOL_SIZE))
+# asyncpg statement cache and SQLAlchemy prepared statement cache, per connection
+DB_STATEMENT_CACHE_SIZE = int(config.get("DB_STATEMENT_CACHE_SIZE", 100))
+DB_PREPARED_STATEMENT_CACHE_SIZE = int(config.get("DB_PREPARED_STATEMENT_CACHE_SIZE", 100))
+
+# Authenticated user cache: TTL in seconds (0 - off) and max users per worker
+AUTH_USER_CACHE_TTL = float(config.get("AUTH_USER_CACHE_TTL", 30))
+AUTH_USER_CACHE_SIZE = int(config.get("AUTH_USER_CACHE_SIZE", 10000))
+
+# Password hashing off the event loop: bcrypt cost, hashing threads (= max concurrent hashes)
+PASSWORD_BCRYPT_ROUNDS = int(config.get("PASSWORD_BCRYPT_ROUNDS", 12))
+PASSWORD_HASH_WORKERS = int(config.get("PASSWORD_HASH_WORKERS", 4))
+
+# OpenAI HTTP client: API base (point it at a stub server in tests), per call timeout, global concurrency, pool size
+OPEN_AI_BASE_URL = config.get("OPEN_AI_BASE_URL", "https://api.openai.com/v1")
+OPEN_AI_TIMEOUT = float(config.get("OPEN_AI_TIMEOUT", 60))
+OPEN_AI_MAX_CONCURRENCY = int(config.get("OPEN_AI_MAX_CONCURRENCY", 16))
+OPEN_AI_POOL_SIZE = int(config.get("OPEN_AI_POOL_SIZE", 32))
+
+# Completion result cache per worker: TTL in seconds (0 - off), max entries; model list refresh period (0 - fetch once)
+PROMPT_CACHE_TTL = float(config.get("PROMPT_CACHE_TTL", 600))
+PROMPT_CACHE_SIZE = int(config.get("PROMPT_CACHE_SIZE", 1000))
+OPEN_AI_MODELS_REFRESH = float(config.get("OPEN_AI_MODELS_REFRESH", 3600))
+
+# Prompt fairness per user and worker: concurrent upstream calls, tokens per rolling window (0 - unlimited),
+# window in seconds; max prompts in one /prompt/batch
+PROMPT_USER_CONCURRENCY = int(config.get("PROMPT_USER_CONCURRENCY", 4))
+PROMPT_TOKEN_BUDGET = int(config.get("PROMPT_TOKEN_BUDGET", 50000))
+PROMPT_TOKEN_WINDOW = float(config.get("PROMPT_TOKEN_WINDOW", 3600))
+PROMPT_BATCH_MAX = int(config.get("PROMPT_BATCH_MAX", 100))
+
+# Image generation jobs: upstream timeout for generation and each download, where generated pictures are stored
+OPEN_AI_IMAGE_TIMEOUT = float(config.get("OPEN_AI_IMAGE_TIMEOUT", 120))
+OPEN_AI_IMAGE_DIR = config.get("OPEN_AI_IMAGE_DIR", "./static/pics")
+# Longest an image job may run - unfinished jobs older than that are failed at startup
+OPEN_AI_IMAGE_JOB_TIMEOUT = float(config.get("OPEN_AI_IMAGE_JOB_TIMEOUT", 600))
+
+# Bulk NDJSON import: rows per validation pass and transaction (one multi-row insert, keep rows * columns < 32767)
+IMPORT_CHUNK_SIZE = int(config.get("IMPORT_CHUNK_SIZE", 5000))
+
+# Monthly message partitions: months made ahead, retention in days (0 - keep everything in the database),
+# archive directory for expired partitions, maintenance period in seconds, archive slices (one chat or author)
+# kept parsed per worker, lock_timeout in seconds of partition DDL and how many times it is tried
+MESSAGE_PARTITION_PREMAKE = int(config.get("MESSAGE_PARTITION_PREMAKE", 2))
+MESSAGE_RETENTION_DAYS = int(config.get("MESSAGE_RETENTION_DAYS", 0))
+MESSAGE_ARCHIVE_DIR = config.get("MESSAGE_ARCHIVE_DIR", "./archive/messages")
+MESSAGE_MAINTENANCE_INTERVAL = float(config.get("MESSAGE_MAINTENANCE_INTERVAL", 3600))
+MESSAGE_ARCHIVE_CACHE_SIZE = int(config.get("MESSAGE_ARCHIVE_CACHE_SIZE", 256))
+MESSAGE_LOCK_TIMEOUT = float(config.get("MESSAGE_LOCK_TIMEOUT", 2))
+MESSAGE_LOCK_RETRIES = int(config.get("MESSAGE_LOCK_RETRIES", 5))
+
+# Chat list page size: default and max
+CHAT_PAGE_SIZE = int(config.get("CHAT_PAGE_SIZE", 50))
+CHAT_PAGE_SIZE_MAX = int(config.get("CHAT_PAGE_SIZE_MAX", 200))